@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Compares assembling GeoJSON properties with group codes against per-id lambdas
+
+The mode results of the old and new test fixtures are repeated under
+shifted ids until there are enough features.
+
+Usage: python benchmarks/bench_geojson_attributes.py [--features 200000]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+from pandas.testing import assert_frame_equal  # noqa: E402
+
+import chameleon.core  # noqa: E402
+from chameleon.core import (  # noqa: E402
+    ChameleonDataFrame,
+    ChameleonDataFrameSet,
+    parse_ids,
+    render_ids,
+)
+
+MODES = ["highway", "name", "ref"]
+# Larger than any id in the fixtures, so the copies never collide
+ID_OFFSET = 10**9
+
+
+def make_parent(features: int) -> SimpleNamespace:
+    cdf_set = ChameleonDataFrameSet(
+        "test/old.csv", "test/new.csv", cache_merges=False
+    )
+    list(cdf_set.query_modes(MODES))
+    feature_count = len(
+        np.unique(
+            np.concatenate(
+                [parse_ids(cdf.index) for cdf in cdf_set.nondeleted]
+            )
+        )
+    )
+    copies = -(-features // feature_count)
+    nondeleted = set()
+    for cdf in cdf_set.nondeleted:
+        keys = parse_ids(cdf.index)
+        scaled = pd.concat([cdf] * copies)
+        scaled.index = render_ids(
+            np.concatenate([keys + copy * ID_OFFSET for copy in range(copies)])
+        )
+        nondeleted.add(ChameleonDataFrame(scaled, cdf.chameleon_mode))
+    return SimpleNamespace(nondeleted=nondeleted)
+
+
+def lambda_attributes(query) -> pd.DataFrame:
+    """
+    Assembles the properties the way OverpassQuery did before group codes
+    """
+    parts = []
+    for cdf in query.parent.nondeleted:
+        cdf_copy = cdf.formatted()
+        cdf_copy.rename(
+            columns={
+                next(
+                    (name for name in cdf.columns if name.startswith("old_")),
+                    "old",
+                ): "old_tag",
+                next(
+                    (name for name in cdf.columns if name.startswith("new_")),
+                    "new",
+                ): "new_tag",
+            },
+            inplace=True,
+        )
+        cdf_copy["change_type"] = cdf.chameleon_mode
+        parts.append(cdf_copy)
+    agg_functions = {
+        "user": lambda user: ",".join(user.unique()),
+        "timestamp": "max",
+        "version": "max",
+        "name": lambda name: ",".join(name.unique()),
+        "highway": lambda highway: ",".join(highway.unique()),
+        "old_tag": lambda old_tag: ",".join(old_tag.unique()),
+        "new_tag": lambda new_tag: ",".join(new_tag.unique()),
+        "change_type": ",".join,
+    }
+    combined = pd.concat(parts)
+    combined.fillna("", inplace=True)
+    combined = combined.astype(str)
+    combined.reset_index(inplace=True)
+    return combined.groupby("id").aggregate(agg_functions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--features", type=int, default=200_000)
+    args = parser.parse_args()
+
+    # Keeps the stores out of the user's cache
+    with TemporaryDirectory() as tempdir:
+        chameleon.core.CACHE_LOCATION = Path(tempdir)
+        parent = make_parent(args.features)
+    query = object.__new__(ChameleonDataFrameSet.OverpassQuery)
+    query.parent = parent
+    print(f"{'implementation':<16}{'features':>10}{'seconds':>10}")
+    results = {}
+    for name, function in (
+        ("lambdas", lambda_attributes),
+        ("group codes", lambda query: query.attributes),
+    ):
+        start = time.perf_counter()
+        results[name] = function(query)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<16}{len(results[name]):>10}{elapsed:>10.2f}")
+
+    assert_frame_equal(results["group codes"], results["lambdas"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Compares grouping changes with integer group codes against per-group lambdas
+
+The name changes between the old and new test fixtures are repeated until
+there are enough rows, then given old and new values that spread them
+over the requested number of groups.
+
+Usage: python benchmarks/bench_group.py [--rows 200000] [--groups 50000]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+from pandas.testing import assert_frame_equal  # noqa: E402
+
+import chameleon.core  # noqa: E402
+from chameleon.core import (  # noqa: E402
+    ChameleonDataFrame,
+    ChameleonDataFrameSet,
+    render_ids,
+)
+
+MODE = "name"
+KEYS = [f"old_{MODE}", f"new_{MODE}", "action"]
+# Larger than any id in the fixtures, so the copies never collide
+ID_OFFSET = 10**9
+
+
+def make_changes(rows: int, groups: int) -> ChameleonDataFrame:
+    cdf_set = ChameleonDataFrameSet(
+        "test/old.csv", "test/new.csv", cache_merges=False
+    )
+    cdf_set.separate_special_dfs()
+    changes = ChameleonDataFrame(cdf_set.source_data, MODE).select_changes()
+    copies = -(-rows // len(changes))
+    keys = np.concatenate(
+        [changes.index + copy * ID_OFFSET for copy in range(copies)]
+    )[:rows]
+    changes = pd.concat([changes] * copies).iloc[:rows]
+    changes.index = render_ids(keys)
+    group_numbers = pd.Series(np.arange(rows) % groups, index=changes.index)
+    for key in KEYS[:2]:
+        changes[key] = (key + " " + group_numbers.astype(str)).astype(
+            "category"
+        )
+    return ChameleonDataFrame(changes, MODE, grouping=True)
+
+
+def lambda_group(changes: pd.DataFrame) -> pd.DataFrame:
+    """
+    Aggregates the way group() did before it used group codes
+    """
+    changes = changes.assign(id=changes.index, count=changes.index)
+    # Not every pandas version keeps missing categorical keys as groups
+    changes[KEYS] = changes[KEYS].astype(object)
+
+    def join_unique(values):
+        return ",".join(str(i) for i in values.unique() if pd.notna(i))
+
+    agg_functions = {
+        "id": ",".join,
+        "count": "count",
+        "user": join_unique,
+        "timestamp": "max",
+        "version": "max",
+        "changeset": join_unique,
+        "highway": join_unique,
+        "barrier": join_unique,
+    }
+    agg_functions = {
+        column: function
+        for column, function in agg_functions.items()
+        if column in changes
+    }
+    grouped = changes.groupby(KEYS, observed=True, dropna=False).aggregate(
+        agg_functions
+    )
+    return grouped.reset_index().set_index("id")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--groups", type=int, default=50_000)
+    args = parser.parse_args()
+
+    # Keeps the stores out of the user's cache
+    with TemporaryDirectory() as tempdir:
+        chameleon.core.CACHE_LOCATION = Path(tempdir)
+        changes = make_changes(args.rows, args.groups)
+    print(f"{'implementation':<16}{'rows':>10}{'groups':>10}{'seconds':>10}")
+    results = {}
+    for name, function in (
+        ("lambdas", lambda_group),
+        ("group codes", ChameleonDataFrame.group),
+    ):
+        frame = changes.copy()
+        start = time.perf_counter()
+        results[name] = function(frame)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:<16}{len(changes):>10}"
+            f"{len(results[name]):>10}{elapsed:>10.2f}"
+        )
+
+    expected = results["lambdas"].rename(
+        columns={"user": "users", "timestamp": "latest_timestamp"}
+    )
+    result = pd.DataFrame(results["group codes"])
+    result = result.drop(columns="url").rename(
+        columns={"changesets": "changeset"}
+    )
+    assert_frame_equal(
+        result.sort_index(axis=1).sort_index().astype(object),
+        expected.sort_index(axis=1).sort_index().astype(object),
+        check_index_type=False,
+    )
+
+
+if __name__ == "__main__":
+    main()
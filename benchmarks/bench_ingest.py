@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Compares parse time and peak memory of the snapshot ingestion backends
+
+The BLZ_allroads test fixtures are scaled up by repeating their rows
+under shifted ids, then each backend merges them in a fresh process.
+
+Usage: python benchmarks/bench_ingest.py [--scale 50]
+"""
+import argparse
+import multiprocessing
+import resource
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+import pandas as pd  # noqa: E402
+
+import chameleon.core  # noqa: E402
+from chameleon.core import (  # noqa: E402
+    CSV_ENGINE,
+    ChameleonDataFrameSet,
+    index_by_key,
+    read_arrow_snapshot,
+)
+
+FIXTURES = (
+    Path("test/BLZ_allroads_2020_02_03.csv"),
+    Path("test/BLZ_allroads_2020_02_27.csv"),
+)
+# Larger than any id in the fixtures, so the copies never collide
+ID_OFFSET = 10**9
+
+
+def scale_fixture(fixture: Path, destination: Path, scale: int) -> None:
+    header, *lines = fixture.read_text().splitlines(keepends=True)
+    rows = [line.split("\t", 2) for line in lines]
+    with destination.open("w") as f:
+        f.write(header)
+        # Overpass orders features by type, then id
+        for feature_type in ("node", "way", "relation"):
+            for copy in range(scale):
+                f.writelines(
+                    f"{ftype}\t{int(fid) + copy * ID_OFFSET}\t{rest}"
+                    for ftype, fid, rest in rows
+                    if ftype == feature_type
+                )
+
+
+def parse(path: Path, engine: str) -> pd.DataFrame:
+    if engine == "pyarrow":
+        return read_arrow_snapshot(path)
+    return index_by_key(pd.read_csv(path, sep="\t", dtype=str))
+
+
+def run(stage: str, old: Path, new: Path, engine: str, queue) -> None:
+    # Keeps the stores out of the user's cache
+    chameleon.core.CACHE_LOCATION = old.parent / "cache"
+    start = time.perf_counter()
+    if stage == "parse":
+        rows = len(parse(old, engine)) + len(parse(new, engine))
+    else:
+        # A raw merge, every row parsed and nothing read from a cache
+        cdf_set = ChameleonDataFrameSet(
+            old,
+            new,
+            csv_engine=engine,
+            prune_unchanged=False,
+            cache_merges=False,
+        )
+        rows = len(cdf_set.source_data)
+    elapsed = time.perf_counter() - start
+    # Kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024
+    queue.put((elapsed, peak, rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scale", type=int, default=50)
+    args = parser.parse_args()
+
+    engines = ["c"]
+    if CSV_ENGINE == "pyarrow":
+        engines.append("pyarrow")
+    else:
+        print("pyarrow is not installed, only the fallback parser is measured")
+
+    context = multiprocessing.get_context("spawn")
+    with TemporaryDirectory() as tempdir:
+        old, new = (Path(tempdir) / fixture.name for fixture in FIXTURES)
+        for fixture, scaled in zip(FIXTURES, (old, new)):
+            scale_fixture(fixture, scaled, args.scale)
+
+        print(
+            f"{'stage':<8}{'engine':<10}{'rows':>10}"
+            f"{'seconds':>10}{'peak RSS MiB':>15}"
+        )
+        for stage in ("parse", "merge"):
+            for engine in engines:
+                queue = context.Queue()
+                process = context.Process(
+                    target=run, args=(stage, old, new, engine, queue)
+                )
+                process.start()
+                elapsed, peak, rows = queue.get()
+                process.join()
+                print(
+                    f"{stage:<8}{engine:<10}{rows:>10}"
+                    f"{elapsed:>10.2f}{peak / 1024:>15.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
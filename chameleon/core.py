@@ -3,16 +3,29 @@ UI-independent classes for processing data
 """
 from __future__ import annotations
 
+import functools
+import hashlib
 import itertools
+import json
 import logging
+import os
 import re
+import sqlite3
+import threading
 import time
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
 from contextlib import suppress
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from io import BytesIO
 from pathlib import Path
-from sqlite3 import OperationalError
-from typing import Generator, Mapping, TextIO
+from typing import Callable, Generator, Iterable, Mapping, TextIO
 
 import appdirs
 import geojson
@@ -20,26 +33,158 @@ import numpy as np
 import overpass
 import pandas as pd
 import requests
-import requests_cache
 import yaml
-from more_itertools import chunked as pager
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+    import pyarrow.feather
+except ImportError:
+    # Fall back to pandas' own parser and Python string operations,
+    # merged data can't be cached
+    pyarrow = None
+    CSV_ENGINE = "c"
+else:
+    CSV_ENGINE = "pyarrow"
 
 pd.options.mode.chained_assignment = None
 
 logger = logging.getLogger(__name__)
 
 SPECIAL_MODES = {"new", "deleted"}
+# The actions of the rows in each special mode's results.
+# Deleted ways that were split or merged are still deletions
+SPECIAL_ACTIONS = {"new": {"new"}, "deleted": {"deleted", "split", "merged"}}
+SEPARATED_ACTIONS = set().union(*SPECIAL_ACTIONS.values())
 TYPE_EXPANSION = {"n": "node", "w": "way", "r": "relation"}
 GEOJSON_OSM = {"Point": "node", "LineString": "way", "Polygon": "way"}
 JOSM_URL = "http://localhost:8111/load_object?new_layer=true&objects="
 OSMCHA_URL = "https://osmcha.mapbox.com/changesets/"
+PEWU_URL = "https://pewu.github.io/osm-history/#/"
+OSM_API_URL = "https://www.openstreetmap.org/api/0.6/"
 OVERPASS_TIMEOUT = (
     180  # Locked until GH mvexel/overpass-api-python-wrapper#112 is fixed
 )
+OVERPASS_ENDPOINT = "https://overpass-api.de/api/interpreter"
+# Pages fetched at once from servers that don't limit slots
+OVERPASS_MAX_IN_FLIGHT = 4
+# Overpass page lengths adapt so pages take about this long
+OVERPASS_PAGE_SECONDS = OVERPASS_TIMEOUT / 6
+# and have at most this many geometry points
+OVERPASS_PAGE_POINTS = 1_000_000
+OVERPASS_MAX_PAGE_LENGTH = 10_000
 CACHE_LOCATION = Path(appdirs.user_cache_dir("Chameleon", "Kaart"))
 HIGH_DELETIONS_THRESHOLD = 5
+# Requests to the OSM API at once, and per second on average
+API_MAX_IN_FLIGHT = 4
+API_REQUESTS_PER_SECOND = 10
+# Times a request is retried after being rate limited,
+# waiting this many seconds if the server doesn't say how long
+API_RETRIES = 3
+API_RETRY_AFTER = 60
+# Longer waits the server asks for fail the request instead
+API_MAX_RETRY_AFTER = 120
+# Visible elements in the element store are fetched again after this long.
+# Deleted ones can't change, so they never are
+ELEMENT_STORE_MAX_AGE = timedelta(hours=12)
+# Least recently used geometries are deleted past this many bytes
+GEOMETRY_STORE_SIZE = 512 * 1024**2
+# Share of a deleted way's nodes that the ways it was split or merged into
+# have to have together
+SUCCESSOR_MIN_COVERAGE = 0.5
+# Columns of the mode results that GeoJSON output properties are made from,
+# besides the mode itself
+GEOJSON_ATTRIBUTES = [
+    "user",
+    "timestamp",
+    "version",
+    "name",
+    "highway",
+    "old_tag",
+    "new_tag",
+]
+# Features fetched per request from the multi-fetch endpoints like ways.json,
+# keeping the URL well under the server's limit
+API_BATCH_SIZE = 300
+# Bump whenever the layout of source_data changes, so stale entries are missed
+MERGE_CACHE_VERSION = 2
+# Least recently used merges are deleted past this many bytes
+MERGE_CACHE_SIZE = 2 * 1024**3
+# Overpass sorts its output by type in this order, then by id
+TYPE_ORDER = {"node": 0, "way": 1, "relation": 2}
+# Feature keys pack the type's TYPE_ORDER above the id bits,
+# so that they sort the same way
+TYPE_SHIFT = 60
+ID_MASK = (1 << TYPE_SHIFT) - 1
+# Input columns every run needs, regardless of mode
+METADATA_COLUMNS = {
+    "@id",
+    "@type",
+    "@user",
+    "@timestamp",
+    "@version",
+    "@changeset",
+}
+# Merged columns that are mostly unique to each feature,
+# so aren't worth encoding as categoricals
+UNENCODED_COLUMNS = {"present", "timestamp", "version", "changeset"}
+# Typed columns made once from the old and new metadata at merge time
+METADATA_RESULT_COLUMNS = {"user", "timestamp", "version", "changeset"}
+# Tags query_cdf adds to every result for context
+CONTEXT_COLUMNS = {"name", "highway", "barrier"}
+# Roughly how important a road is for routing, most important first
+HIGHWAY_VALUES = {
+    "motorway": 1,
+    "motorway_link": 1,
+    "trunk": 2,
+    "trunk_link": 2,
+    "primary": 3,
+    "primary_link": 3,
+    "secondary": 4,
+    "secondary_link": 4,
+    "tertiary": 5,
+    "tertiary_link": 5,
+    "unclassified": 6,
+    "residential": 6,
+    "service": 6,
+    "track": 6,
+    "footway": 8,
+    "path": 8,
+    "steps": 8,
+    "cycleway": 8,
+    "pedestrian": 8,
+}
+# Rules for changes that don't affect routing, in the form of config rules
+DEFAULT_FILTER_RULES = [
+    {"modes": ["oneway"], "ignore_values": ["no", None]},
+    {
+        "modes": ["access"],
+        "require_any": ["highway", "barrier"],
+        "ignore_values": ["yes", None],
+    },
+    {"modes": ["barrier"], "feature_types": ["node"]},
+    {"modes": ["construction", "name"], "require_any": ["highway"]},
+]
 
 OsmObj = namedtuple("OsmObj", "obj_type obj_id")
+# The outcome of checking one feature on the OSM API,
+# error is None if it worked
+ApiCheck = namedtuple(
+    "ApiCheck", "feature_id element_attribs from_cache error"
+)
+# An Overpass server's status: its clock, slots per client, free slots,
+# when taken slots free up, and when the running queries started
+SlotStatus = namedtuple(
+    "SlotStatus", "current_time rate_limit available waiting running"
+)
+# A mask over a mode's changes, for the given modes or all of them if None,
+# the input columns it reads, and what it adds to the changes it keeps
+FilterRule = namedtuple("FilterRule", "modes keep columns scores")
+# Lookup from a feature key's type bits
+TYPE_NAMES = list(TYPE_ORDER)
+# The type letter, if any, and the digits at the end of an id like "w123"
+FEATURE_ID_REGEX = re.compile(r"\A([nwr])?.*?(\d+)\Z")
 
 
 class ChameleonDataFrame(pd.DataFrame):
@@ -99,155 +244,117 @@ class ChameleonDataFrame(pd.DataFrame):
         Takes a dataframe that has already been merged from two input files
         and queries it for changes in the given tag
         """
-        intermediate_df = (
-            self.loc[
-                (
-                    self[f"{self.chameleon_mode_cleaned}_old"].fillna("")
-                    != self[f"{self.chameleon_mode_cleaned}_new"].fillna("")
-                )
-            ]
-            if self.chameleon_mode not in SPECIAL_MODES
-            else self
-        )
-
-        def get_column_from_intermediate(column: str) -> None:
-            try:
-                self[column] = intermediate_df[f"{column}_new"].fillna(
-                    intermediate_df[f"{column}_old"]
-                )
-            except KeyError:
-                with suppress(KeyError):
-                    # Succeeds if one csv had a name column
-                    self[column] = intermediate_df[column]
-
-        # self = ChameleonDataFrame(
-        #     mode=self.chameleon_mode, grouping=self.grouping)
-
-        self["url"] = JOSM_URL + self.index
-        self["pewu"] = self.index.to_series().apply(pewu_from_id)
-        self["user"] = intermediate_df["user_new"].fillna(
-            intermediate_df["user_old"]
-        )
-        self["timestamp"] = pd.to_datetime(
-            intermediate_df["timestamp_new"].fillna(
-                intermediate_df["timestamp_old"]
-            )
-        ).dt.strftime("%Y-%m-%d")
-        self["version"] = intermediate_df["version_new"].fillna(
-            intermediate_df["version_old"]
-        )
-
-        # Drop all but these columns
-        self = self[["url", "pewu", "user", "timestamp", "version"]]
-        try:
-            # Succeeds if both csvs had changeset columns
-            self["changeset"] = intermediate_df["changeset_new"]
-            self["osmcha"] = OSMCHA_URL + self["changeset"]
-        except KeyError:
-            try:
-                # Succeeds if one csv had a changeset column
-                self["changeset"] = intermediate_df["changeset"]
-                self["osmcha"] = OSMCHA_URL + self["changeset"]
-            except KeyError:
-                # If neither had one, we just won't include in the output
-                pass
+        return self.select_changes().finalize()
 
-        for column in ("name", "highway", "barrier"):
-            if self.chameleon_mode != column:
-                get_column_from_intermediate(column)
-
-        # Renaming columns to be consistent with old Chameleon outputs
-        if (
-            self.chameleon_mode not in SPECIAL_MODES
-        ):  # Skips the new and deleted DFs
-            self[f"old_{self.chameleon_mode_cleaned}"] = intermediate_df[
-                f"{self.chameleon_mode_cleaned}_old"
-            ]
-            self[f"new_{self.chameleon_mode_cleaned}"] = intermediate_df[
-                f"{self.chameleon_mode_cleaned}_new"
-            ]
+    def select_changes(self) -> ChameleonDataFrame:
+        """
+        Narrows the merged dataframe down to the rows and columns
+        relevant to this mode, without grouping or filtering.
+        Columns are only derived for the rows that changed
+        """
+        if self.chameleon_mode not in SPECIAL_MODES:
+            # Raises KeyError if the files don't have the tag
+            changes = select_all_changes(
+                self, [self.chameleon_mode], compile_filters(self.config)
+            )[self.chameleon_mode]
         else:
+            # Every row of the new and deleted dataframes is a change
+            changes = change_details(self)
             extra_columns = sorted(
-                {
-                    strip_column_suffix(column_name)
-                    for column_name in intermediate_df.columns
-                }
-                - set(self.columns)
-                - {"present", "type", "action"}
+                {strip_column_suffix(column_name) for column_name in self}
+                - set(changes.columns)
+                - {"present", "action"}
             )
             for column in extra_columns:
-                get_column_from_intermediate(column)
+                changes[column] = coalesce(self, column)
+            changes["action"] = self["action"]
+            changes.dropna(subset=["action"], inplace=True)
+        return ChameleonDataFrame(
+            changes,
+            mode=self.chameleon_mode,
+            grouping=self.grouping,
+            config=self.config,
+        )
 
-        self["action"] = intermediate_df["action"]
+    def finalize(self, rules: list[FilterRule] = None) -> ChameleonDataFrame:
+        """
+        Filters, groups and sorts a dataframe of changes from select_changes().
+        Rules compiled from the config can be passed in
+        to save compiling them for every mode
+        """
+        self = self.filter(rules)
+        self.index = render_ids(self.index)
         if self.grouping:
             self = self.group()
-        self.dropna(subset=["action"], inplace=True)
-        # Only use filter if there are settings other than ignored modes
-        if set(self.config.keys()) - {"ignored_modes"}:
-            self = self.filter()
-        self.fillna("", inplace=True)
+        # Categoricals can only be filled with one of their categories
+        for column in self.select_dtypes("category"):
+            self[column] = self[column].astype(
+                self[column].cat.categories.dtype
+            )
+        # Typed columns stay missing until they are formatted for output
+        self.fillna(
+            {
+                column: ""
+                for column in self.select_dtypes(["object", "string"])
+            },
+            inplace=True,
+        )
         self.sort()
         return self
 
+    def formatted(self) -> ChameleonDataFrame:
+        """
+        A copy with the typed columns written out as they are in output files
+        """
+        formatted = self.copy()
+        for column in formatted.select_dtypes("datetimetz"):
+            formatted[column] = formatted[column].dt.strftime("%Y-%m-%d")
+        for column, dtype in formatted.dtypes.items():
+            if isinstance(dtype, pd.Int64Dtype):
+                formatted[column] = (
+                    formatted[column].astype("string").astype(object)
+                )
+        return formatted.fillna("")
+
     def group(self) -> ChameleonDataFrame:
         """
         Groups changes by type of change.
         (Each combination of old_value, new_value, and action)
         """
-        self["count"] = self["id"] = self.index
-        agg_functions = {
-            "id": ",".join,
-            "count": "count",
-            "user": lambda user: ",".join(user.unique()),
-            "timestamp": "max",
-            "version": "max",
-            "changeset": lambda changeset: ",".join(changeset.unique()),
-        }
-        if self.chameleon_mode != "name":
-            agg_functions["name"] = lambda name: ",".join(
-                str(i) for i in name.unique() if pd.notna(i)
-            )
-        if self.chameleon_mode != "highway":
-            agg_functions["highway"] = lambda highway: ",".join(
-                str(i) for i in highway.unique() if pd.notna(i)
-            )
-        # Create the new dataframe
-        grouped_df = self.groupby(
-            [
-                f"old_{self.chameleon_mode_cleaned}",
-                f"new_{self.chameleon_mode_cleaned}",
-                "action",
-            ],
-            as_index=False,
-        ).aggregate(agg_functions)
-
-        # Get the grouped columns out of the index to be more visible
-        grouped_df.reset_index(inplace=True)
-        grouped_df.set_index("id", inplace=True)
-
-        grouped_df["url"] = JOSM_URL + grouped_df.index
-
-        # Send those columns to the end of the frame
-        new_column_order = [
-            "url",
-            "count",
-            "user",
-            "timestamp",
-            "version",
-            "changeset",
-        ]
-        if self.chameleon_mode != "name":
-            new_column_order += ["name"]
-        if self.chameleon_mode != "highway":
-            new_column_order += ["highway"]
-        if self.chameleon_mode != "barrier":
-            new_column_order += ["barrier"]
-        new_column_order += [
+        keys = [
             f"old_{self.chameleon_mode_cleaned}",
             f"new_{self.chameleon_mode_cleaned}",
             "action",
         ]
-        grouped_df = grouped_df[new_column_order]
+        # Missing values make a group of their own, e.g. for an added tag
+        key_codes = pd.DataFrame({key: group_keys(self[key]) for key in keys})
+        codes = key_codes.groupby(keys).ngroup().to_numpy()
+        _, firsts = np.unique(codes, return_index=True)
+        group_count = len(firsts)
+
+        grouped_df = pd.DataFrame(index=pd.RangeIndex(group_count))
+        grouped_df["id"] = join_groups(codes, self.index, group_count)
+        grouped_df["url"] = JOSM_URL + grouped_df["id"]
+        grouped_df["count"] = np.bincount(codes, minlength=group_count)
+        grouped_df["user"] = join_groups(codes, self["user"], group_count)
+        for column in ("timestamp", "version"):
+            grouped_df[column] = (
+                self[column].groupby(codes).max().reset_index(drop=True)
+            )
+        # Only present if at least one csv had a changeset column
+        if "changeset" in self:
+            grouped_df["changeset"] = join_groups(
+                codes, self["changeset"], group_count
+            )
+        for column in ("name", "highway", "barrier", "successors"):
+            if column != self.chameleon_mode and column in self:
+                grouped_df[column] = join_groups(
+                    codes, self[column], group_count
+                )
+        for key in keys:
+            grouped_df[key] = self[key].iloc[firsts].reset_index(drop=True)
+
+        grouped_df.set_index("id", inplace=True)
 
         grouped_df.rename(
             columns={
@@ -273,71 +380,26 @@ class ChameleonDataFrame(pd.DataFrame):
             self.sort_values(sortable_values, inplace=True)
         return self
 
-    def filter(self) -> ChameleonDataFrame:
-        # Drop oneway changes that don't affect routing
-        if self.chameleon_mode == "oneway":
-            self = self[
-                ~(
-                    self["old_oneway"].isin(["no", np.nan])
-                    & self["new_oneway"].isin(["no", np.nan])
-                )
-            ]
-
-        # Drop access changes that don't affect routing
-        if self.chameleon_mode == "access":
-            self = self[self["highway"].notnull() | self["barrier"].notnull()]
-            self = self[
-                ~(
-                    self["old_access"].isin(["yes", np.nan])
-                    & self["new_access"].isin(["yes", np.nan])
-                )
-            ]
-
-        if self.chameleon_mode == "barrier":
-            self = self[self.index.str.startswith("n")]
-
-        if self.chameleon_mode in ["construction", "name"]:
-            self = self[self["highway"].notnull()]
-
-        # Drop rows with Kaart users tagged
-        if whitelist := self.config.get("user_whitelist", []):
-            self = self[~self["user"].isin(whitelist)]
-
-        if self.chameleon_mode == "highway":
-            highway_vals = {
-                "motorway": 1,
-                "motorway_link": 1,
-                "trunk": 2,
-                "trunk_link": 2,
-                "primary": 3,
-                "primary_link": 3,
-                "secondary": 4,
-                "secondary_link": 4,
-                "tertiary": 5,
-                "tertiary_link": 5,
-                "unclassified": 6,
-                "residential": 6,
-                "service": 6,
-                "track": 7 if self.config.get("tracks_are_pedestrian") else 6,
-                "footway": 8,
-                "path": 8,
-                "steps": 8,
-                "cycleway": 8,
-                "pedestrian": 8,
-            }
-            self["highway_change_score"] = abs(
-                self["old_highway"].map(highway_vals)
-                - self["new_highway"].map(highway_vals)
-            )
-
-            always_include = self.config.get("always_include", [])
-            step_change = self.config.get("highway_step_change", 0)
-            self = self[
-                self["old_highway"].isin(always_include)
-                | self["new_highway"].isin(always_include)
-                | (self["highway_change_score"] >= step_change)
-            ]
-
+    def filter(self, rules: list[FilterRule] = None) -> ChameleonDataFrame:
+        """
+        Drops the changes that the filter rules for this mode don't keep.
+        Expects the rows to still be indexed by feature key
+        """
+        if rules is None:
+            rules = compile_filters(self.config)
+        keep = np.ones(len(self), dtype=bool)
+        scores = {}
+        for rule in rules:
+            if rule.modes is None or self.chameleon_mode in rule.modes:
+                keep &= rule.keep(self)
+                if rule.scores is not None:
+                    scores.update(rule.scores(self))
+        if not keep.all():
+            self = self[keep]
+            scores = {name: values[keep] for name, values in scores.items()}
+        if scores:
+            # Kept in the output to show how each change scored
+            self = self.assign(**scores)
         return self
 
 
@@ -355,7 +417,41 @@ class ChameleonDataFrameSet(set):
         use_api=False,
         extra_columns=None,
         config: Mapping | str | Path = None,
+        chunksize: int = None,
+        modes: Iterable[str] = None,
+        csv_engine: str = CSV_ENGINE,
+        prune_unchanged: bool = True,
+        cache_merges: bool = True,
+        api_rate: float = API_REQUESTS_PER_SECOND,
     ):
+        """
+        modes: if given, only the columns these modes need are read
+        from the input files
+
+        csv_engine: "pyarrow" parses the input files with the multithreaded
+        Arrow reader and keeps tags as Arrow strings,
+        "c" uses pandas' own parser and Python strings.
+        The streaming merge always uses the latter
+
+        chunksize: if set, the snapshots are merged by walking both files
+        in type/id order, this many rows at a time,
+        instead of reading them fully into memory
+
+        prune_unchanged: leaves features whose lines are identical
+        in both files out of source_data, without parsing them.
+        The streaming merge instead drops each chunk's modified features
+        that didn't change in any of the modes, or in any column
+        if no modes are given, once the chunk is joined
+
+        cache_merges: keeps the merged data of every file pair in a cache
+        on disk, keyed by the contents of both files and the columns read,
+        so later runs on the same files skip parsing and merging.
+        Needs pyarrow,
+        not done by the streaming merge
+
+        api_rate: average OSM API requests per second,
+        across every thread checking features
+        """
         super().__init__(self)
         if extra_columns is None:
             extra_columns = {}
@@ -367,6 +463,12 @@ class ChameleonDataFrameSet(set):
             self.newfile = Path(self.newfile)
 
         self.extra_columns = extra_columns
+        self.chunksize = chunksize
+        self.selected_modes = set(modes) if modes is not None else None
+        self.csv_engine = csv_engine
+        self.prune_unchanged = prune_unchanged
+        self.cache_merges = cache_merges and pyarrow is not None
+        self.unchanged_count = 0
 
         if isinstance(config, Mapping):
             self.config = config
@@ -379,6 +481,8 @@ class ChameleonDataFrameSet(set):
         self.source_data = None
         self.deleted_way_members = {}
         self.overpass_result_attribs = {}
+        # Shared by every thread checking features on the OSM API
+        self.api_limiter = TokenBucket(api_rate, capacity=API_MAX_IN_FLIGHT)
         self.setup_cache()
 
         self.merge_files()
@@ -391,22 +495,23 @@ class ChameleonDataFrameSet(set):
         )
 
     def setup_cache(self) -> None:
+        self.session = requests.Session()
         try:
             CACHE_LOCATION.mkdir(exist_ok=True, parents=True)
-            expiry = timedelta(hours=12)
-            self.session = requests_cache.CachedSession(
-                backend=requests_cache.backends.sqlite.SQLiteCache(
-                    db_path=CACHE_LOCATION / "cache.sqlite",
-                ),
-                expire_after=expiry,
+            self.element_store = ElementStore(
+                CACHE_LOCATION / "elements.sqlite"
             )
-            self.session.remove_expired_responses()
-            logger.debug("Request caching enabled")
-        except (OSError, OperationalError):
+            self.geometry_store = GeometryStore(
+                CACHE_LOCATION / "geometries.sqlite"
+            )
+            logger.debug("Element and geometry stores enabled")
+        except (OSError, sqlite3.Error):
             logger.error(
-                "Could not create cache directory. Request caching disabled."
+                "Could not create cache directory. "
+                "Element and geometry stores disabled."
             )
-            self.session = requests.Session()
+            self.element_store = None
+            self.geometry_store = None
 
     @property
     def modes(self) -> set[str]:
@@ -416,76 +521,319 @@ class ChameleonDataFrameSet(set):
     def modes_cleaned(self) -> set[str]:
         return {i.chameleon_mode_cleaned for i in self}
 
+    @property
+    def needed_columns(self) -> set[str] | None:
+        """
+        The input columns the selected modes and the filter rules use,
+        or None if every column should be read
+        """
+        if self.selected_modes is None:
+            return None
+        rules = compile_filters(self.config)
+        return (
+            METADATA_COLUMNS
+            | CONTEXT_COLUMNS
+            | self.selected_modes
+            | set().union(*(rule.columns for rule in rules))
+        )
+
+    def read_snapshot(
+        self, source: Path | TextIO, columns: set[str] | None, **kwargs
+    ) -> pd.DataFrame | Iterable[pd.DataFrame]:
+        """
+        Reads one of the input files, indexed by feature key
+
+        columns: if given, only these columns are read
+        """
+        # The Arrow reader can't read in chunks
+        if self.csv_engine == "pyarrow" and not kwargs.get("chunksize"):
+            return read_arrow_snapshot(source, columns)
+
+        if columns is not None:
+            kwargs["usecols"] = lambda column: column.strip() in columns
+        snapshot = pd.read_csv(source, sep="\t", dtype=str, **kwargs)
+        if kwargs.get("chunksize"):
+            return (index_by_key(chunk) for chunk in snapshot)
+        return index_by_key(snapshot)
+
     def merge_files(self) -> ChameleonDataFrameSet:
         """
         Merge two csv inputs into a single combined dataframe
         """
-        # dtypes = {
-        #     # '@id': int,
-        #     # '@version': int
-        #     '@timestamp': datetime
-        # }
-        old_df = pd.read_csv(
-            self.oldfile, sep="\t", index_col=["@id", "@type"], dtype=str
+        if self.chunksize:
+            self.source_data = finish_merge(pd.concat(self.merged_chunks()))
+        elif self.cache_merges:
+            self.source_data = self.cached_join()
+        else:
+            self.source_data = finish_merge(
+                self.join_files(self.needed_columns)
+            )
+        return self
+
+    def cached_join(self) -> pd.DataFrame:
+        """
+        Reads the merged data from the cache,
+        or joins the files and adds them to the cache
+
+        Entries are kept per set of columns read, so a miss parses
+        no more columns than the uncached merge would.
+        An entry with every column also serves runs of any modes
+        """
+        # Hashed once, the files are the same for every lookup
+        contents = b"".join(map(snapshot_digest, (self.oldfile, self.newfile)))
+        lookups = [self.needed_columns]
+        if self.needed_columns is not None:
+            lookups.append(None)
+        for columns in lookups:
+            cache_file = self.merge_cache_file(columns, contents)
+            try:
+                # Memory mapped, so only the columns this run needs are read
+                table = pyarrow.feather.read_table(cache_file, memory_map=True)
+            except (OSError, pyarrow.ArrowInvalid):
+                continue
+            logger.debug("Read merged data from %s", cache_file)
+            # Marks the entry as recently used
+            cache_file.touch()
+            self.unchanged_count = int(
+                table.schema.metadata[b"chameleon_unchanged_count"]
+            )
+            # The feature key index is kept as the column from @id
+            merged = table.select(
+                merged_columns(table.column_names, self.needed_columns)
+            ).to_pandas()
+            # Only the Arrow reader gives string columns, but pandas
+            # only records that they were strings, not how they were stored
+            for column in merged.select_dtypes("string"):
+                merged[column] = merged[column].astype(
+                    pd.StringDtype("pyarrow")
+                )
+            return merged
+
+        cache_file = self.merge_cache_file(self.needed_columns, contents)
+        merged = finish_merge(self.join_files(self.needed_columns))
+        table = pyarrow.Table.from_pandas(merged)
+        unchanged_count = str(self.unchanged_count).encode()
+        table = table.replace_schema_metadata(
+            {
+                **table.schema.metadata,
+                b"chameleon_unchanged_count": unchanged_count,
+            }
         )
-        new_df = pd.read_csv(
-            self.newfile, sep="\t", index_col=["@id", "@type"], dtype=str
+        try:
+            cache_file.parent.mkdir(exist_ok=True, parents=True)
+            # Written under another name first, so that other processes
+            # never read a partly written entry
+            partial_file = cache_file.with_suffix(f".{os.getpid()}.partial")
+            pyarrow.feather.write_feather(table, partial_file)
+            partial_file.replace(cache_file)
+            evict_merge_cache(cache_file)
+        except OSError:
+            logger.error("Could not write to the merge cache.")
+        return merged
+
+    def merge_cache_file(
+        self, columns: set[str] | None, contents: bytes
+    ) -> Path:
+        """
+        Where the merged data of both input files is cached,
+        as read with the current settings
+
+        columns: the input columns read, or None for every column
+
+        contents: the digests of both input files
+        """
+        key = hashlib.blake2b(digest_size=16)
+        settings = (
+            MERGE_CACHE_VERSION,
+            self.csv_engine,
+            self.prune_unchanged,
+            None if columns is None else sorted(columns),
         )
-        # Cast a couple items to more specific types
-        # for col, col_type in dtypes.items():
-        # old_df[col] = old_df[col].astype(col_type)
-        # new_df[col] = new_df[col].astype(col_type)
-        # Used to indicate which sheet(s) each row came from post-join
-        old_df["present"] = new_df["present"] = True
-
-        self.source_data = old_df.join(
-            new_df, how="outer", lsuffix="_old", rsuffix="_new"
+        key.update(repr(settings).encode())
+        key.update(contents)
+        return CACHE_LOCATION / "merged" / f"{key.hexdigest()}.feather"
+
+    def join_files(self, columns: set[str] | None) -> pd.DataFrame:
+        """
+        Reads both files fully into memory and joins them,
+        leaving out features that are unchanged if self.prune_unchanged
+
+        columns: if given, only these columns are read
+        """
+        old_source, new_source = self.oldfile, self.newfile
+        if self.prune_unchanged:
+            old_source, new_source = self.pruned_snapshots()
+        old_df = self.read_snapshot(old_source, columns)
+        new_df = self.read_snapshot(new_source, columns)
+        return join_snapshots(old_df, new_df)
+
+    def pruned_snapshots(self) -> tuple[BytesIO, BytesIO]:
+        """
+        Copies of both input files without the lines they have in common.
+        A feature with identical lines in both is unchanged,
+        so it can't show up in any mode's results
+        """
+        old_lines = snapshot_lines(self.oldfile)
+        new_lines = snapshot_lines(self.newfile)
+        if old_lines[:1] == new_lines[:1]:
+            # Lines can only be compared if the columns are the same
+            unchanged = set(old_lines[1:]).intersection(new_lines[1:])
+        else:
+            unchanged = set()
+        self.unchanged_count = len(unchanged)
+        return tuple(
+            BytesIO(
+                b"".join(
+                    [
+                        *lines[:1],
+                        *(line for line in lines[1:] if line not in unchanged),
+                    ]
+                )
+            )
+            for lines in (old_lines, new_lines)
         )
-        self.source_data["present_old"].fillna(False, inplace=True)
-        self.source_data["present_new"].fillna(False, inplace=True)
 
-        self.source_data.reset_index(inplace=True)
+    @property
+    def feature_count(self) -> int:
+        """
+        How many features are in either file,
+        including unchanged ones that were pruned
+        """
+        return len(self.source_data) + self.unchanged_count
+
+    def update_feature(
+        self, feature_id: int, element_attribs: Mapping
+    ) -> None:
+        """
+        Writes a feature's attributes from the OSM API into the merged data.
+        Use update_features for more than one
+        """
+        self.update_features({feature_id: element_attribs})
 
-        # Eliminate special chars that mess pandas up
-        self.source_data.columns = self.source_data.columns.str.replace("@", "")
-        self.source_data.columns = self.source_data.columns.str.replace(":", "_")
-        # Strip whitespace
-        self.source_data.columns = self.source_data.columns.str.strip()
+    def update_features(self, updates: Mapping[int, Mapping]) -> None:
+        """
+        Writes the attributes from the OSM API of many features, keyed by
+        feature, into the merged data at once, adding any values its encoded
+        columns don't have yet, and updates their typed metadata columns
+        """
+        updates = pd.DataFrame.from_dict(updates, orient="index")
+        if updates.empty:
+            return
+        updates = updates[
+            updates.columns.intersection(self.source_data.columns)
+        ]
+        for column in updates:
+            values = updates[column].dropna()
+            if isinstance(self.source_data[column].dtype, pd.CategoricalDtype):
+                new_categories = values[
+                    ~values.isin(self.source_data[column].cat.categories)
+                ].unique()
+                # Both columns of a pair, and the typed column made from them,
+                # have to keep the same categories
+                base = strip_column_suffix(column)
+                for pair_column in (f"{base}_old", f"{base}_new", base):
+                    if len(new_categories) and pair_column in self.source_data:
+                        self.source_data[pair_column] = self.source_data[
+                            pair_column
+                        ].cat.add_categories(new_categories)
+            updated = self.source_data[column].copy()
+            updated.update(values)
+            self.source_data[column] = updated
+
+        metadata = add_metadata_columns(
+            self.source_data.loc[updates.index].copy()
+        )
+        for column in METADATA_RESULT_COLUMNS & set(metadata.columns):
+            updated = self.source_data[column].copy()
+            updated.update(metadata[column])
+            self.source_data[column] = updated
 
-        self.source_data["id"] = self.source_data["type"].str[
-            0
-        ] + self.source_data["id"].astype(str)
-        self.source_data.set_index("id", inplace=True)
+    def merged_chunks(self) -> Generator[pd.DataFrame, None, None]:
+        """
+        Streaming merge-join of the two snapshots
 
-        try:
-            self.source_data.loc[
-                self.source_data.present_old & self.source_data.present_new,
-                "action",
-            ] = "modified"
-            self.source_data.loc[
-                self.source_data.present_old & ~self.source_data.present_new,
-                "action",
-            ] = "deleted"
-            self.source_data.loc[
-                ~self.source_data.present_old & self.source_data.present_new,
-                "action",
-            ] = "new"
-        except ValueError:
-            # No change for this mode, add a placeholder column
-            self.source_data["action"] = np.nan
-        return self
+        Both files must be sorted by type and id, as Overpass outputs them.
+        Rows are read self.chunksize at a time from each file, and every row
+        up to the lowest id both files have reached is joined and yielded.
+        Reading takes memory by the chunk size, but the yielded rows are
+        kept, so if self.prune_unchanged only changes are yielded
+        """
+        # As with pruned_snapshots, whole rows are only compared
+        # if the files have the same columns
+        prune = self.prune_unchanged and (
+            self.selected_modes is not None
+            or snapshot_header(self.oldfile) == snapshot_header(self.newfile)
+        )
+        self.unchanged_count = 0
+        readers = [
+            self.read_snapshot(
+                f, self.needed_columns, chunksize=self.chunksize
+            )
+            for f in (self.oldfile, self.newfile)
+        ]
+        buffers = [None, None]
+        last_keys = [-1, -1]
+        exhausted = [False, False]
+
+        while True:
+            for side, reader in enumerate(readers):
+                # Refill any buffer that has been used up
+                while not exhausted[side] and (
+                    buffers[side] is None or buffers[side].empty
+                ):
+                    try:
+                        chunk = next(reader)
+                    except StopIteration:
+                        exhausted[side] = True
+                        break
+                    keys = chunk.index.to_numpy()
+                    if len(keys) and (
+                        keys[0] <= last_keys[side]
+                        or (np.diff(keys) <= 0).any()
+                    ):
+                        raise ValueError(
+                            "Streaming merge requires both files "
+                            "to be sorted by type and id"
+                        )
+                    if len(keys):
+                        last_keys[side] = keys[-1]
+                    buffers[side] = chunk
+            if all(exhausted) and all(b is None or b.empty for b in buffers):
+                break
+            # Every row at or below the boundary has been read from both files
+            boundary = min(
+                np.inf if exhausted[side] else last_keys[side]
+                for side in (0, 1)
+            )
+            ready = []
+            for side, buffer in enumerate(buffers):
+                if buffer is None:
+                    buffer = buffers[side] = pd.DataFrame(
+                        index=pd.Index([], dtype=np.int64, name="id")
+                    )
+                is_ready = buffer.index.to_numpy() <= boundary
+                ready.append(buffer[is_ready])
+                buffers[side] = buffer[~is_ready]
+            merged = join_snapshots(*ready)
+            if prune:
+                unchanged = unchanged_rows(merged, self.selected_modes)
+                self.unchanged_count += int(unchanged.sum())
+                merged = merged[~unchanged]
+            yield merged
 
     def separate_special_dfs(self) -> ChameleonDataFrameSet:
         """
         Separate creations and deletions into their own dataframes
         """
         special_dataframes = {
-            mode: self.source_data[self.source_data["action"] == mode]
+            mode: self.source_data[
+                self.source_data["action"].isin(SPECIAL_ACTIONS[mode])
+            ]
             for mode in SPECIAL_MODES - self.config.get("ignored_modes", set())
         }
         # Remove the new/deleted ways from the source_data
         self.source_data = self.source_data[
-            ~self.source_data["action"].isin(SPECIAL_MODES)
+            ~self.source_data["action"].isin(SEPARATED_ACTIONS)
         ]
         for mode, df in special_dataframes.items():
             self.add(
@@ -495,6 +843,135 @@ class ChameleonDataFrameSet(set):
             )
         return self
 
+    def query_modes(
+        self, modes: Iterable[str], grouping=False
+    ) -> Generator[str, None, None]:
+        """
+        Separates the special dataframes, then queries each mode
+        and adds the results to the set.
+
+        Yields each mode as it starts processing.
+        Modes that can't be queried are logged and left out of the set.
+        """
+        modes = list(modes)
+        special_modes = SPECIAL_MODES - self.config.get("ignored_modes", set())
+        changes_by_mode = select_mode_changes(
+            self.source_data, modes, self.config
+        )
+        rules = compile_filters(self.config)
+        # Matches what separate_special_dfs() leaves behind
+        self.source_data = self.source_data[
+            ~self.source_data["action"].isin(SEPARATED_ACTIONS)
+        ]
+
+        for mode in [*special_modes, *modes]:
+            if mode in modes:
+                yield mode
+            try:
+                result = ChameleonDataFrame(
+                    changes_by_mode[mode],
+                    mode=mode,
+                    grouping=grouping and mode not in special_modes,
+                    config=self.config,
+                ).finalize(rules)
+            except KeyError:
+                logger.exception("Could not query %s", mode)
+                continue
+            self.add(result)
+
+    def check_deletions_on_overpass(
+        self, api: overpass.API | None = None
+    ) -> list[int]:
+        """
+        Asks Overpass, a page of ids per query, which features marked deleted
+        still exist. Those were only dropped, and are updated in source_data
+        all at once. Returns the keys of the rest, which still need checking
+        on the OSM API, including any of pages Overpass failed to answer
+        """
+        df = self.source_data
+        deleted_keys = df.index[df["action"] == "deleted"]
+        if api is None:
+            api = overpass.API(timeout=OVERPASS_TIMEOUT)
+        updates = {}
+        for query in overpass_id_pages(deleted_keys, self.page_length):
+            try:
+                response = api.get(
+                    query, verbosity="meta", responseformat="json"
+                )
+            except (overpass.OverpassError, requests.RequestException) as e:
+                logger.error("Couldn't check deletions on Overpass: %s", e)
+                continue
+            elements = response["elements"]
+            keys = pack_ids(
+                [element["type"] for element in elements],
+                [element["id"] for element in elements],
+            )
+            for key, element in zip(keys, elements):
+                updates[key] = latest_version_attribs(element)
+            if self.element_store:
+                for feature_type in TYPE_NAMES:
+                    self.element_store.put_many(
+                        feature_type,
+                        [
+                            element
+                            for element in elements
+                            if element["type"] == feature_type
+                        ],
+                    )
+        self.update_features(updates)
+        return [key for key in deleted_keys if key not in updates]
+
+    def detect_splits_and_merges(
+        self, api: overpass.API | None = None
+    ) -> None:
+        """
+        Relabels deleted ways whose nodes now belong to other ways as split
+        or merged, with the ids of those ways as successors. Uses the last
+        members of deleted ways found while checking them on the OSM API.
+        The current ways that have any of those nodes come from Overpass,
+        a page of node ids per query
+        """
+        features = list(map(feature_type_and_number, self.deleted_way_members))
+        keys = pack_ids(
+            [feature.obj_type for feature in features],
+            [feature.obj_id for feature in features],
+        )
+        df = self.source_data
+        deleted_keys = set(df.index[df["action"] == "deleted"])
+        deleted_members = {
+            key: nodes
+            for key, nodes in zip(keys, self.deleted_way_members.values())
+            if key in deleted_keys
+        }
+        if not deleted_members:
+            return
+        node_ids = np.unique(np.concatenate(list(deleted_members.values())))
+        node_keys = pack_ids(["node"] * len(node_ids), node_ids)
+        if api is None:
+            api = overpass.API(timeout=OVERPASS_TIMEOUT)
+        way_nodes = {}
+        for query in overpass_id_pages(node_keys, self.page_length):
+            try:
+                response = api.get(
+                    f"{query}way(bn);", verbosity="body", responseformat="json"
+                )
+            except (overpass.OverpassError, requests.RequestException) as e:
+                logger.error("Couldn't fetch ways of deleted nodes: %s", e)
+                continue
+            for element in response["elements"]:
+                if element["type"] == "way":
+                    way_nodes[element["id"]] = element["nodes"]
+        way_keys = pack_ids(["way"] * len(way_nodes), list(way_nodes))
+        way_nodes = dict(zip(way_keys, way_nodes.values()))
+        successors = match_successors(deleted_members, way_nodes)
+        if successors.empty:
+            return
+        if "successors" not in self.source_data:
+            self.source_data["successors"] = pd.Series(
+                None, index=self.source_data.index, dtype=object
+            )
+        self.update_features(successors.to_dict("index"))
+
     def check_feature_on_api(
         self, feature_id: str, app_version: str = ""
     ) -> tuple(dict, bool):
@@ -502,57 +979,229 @@ class ChameleonDataFrameSet(set):
         Checks whether a way was deleted on the server
         """
 
-        if app_version:
-            app_version = f" {app_version}".rstrip()
-
         if feature_id in self.overpass_result_attribs:
             # TODO May be obsoleted by use of cache
             return self.overpass_result_attribs[feature_id]
-        feature_type, feature_id_num = split_id(feature_id)
-        response = self.session.get(
-            "https://www.openstreetmap.org/api/0.6/"
-            f"{feature_type}/{feature_id_num}/history.json",
-            timeout=5,
-            headers={
-                "User-Agent": f"Kaart Chameleon{app_version}",
-                "From": "dev@kaart.com",
-            },
+        feature = feature_type_and_number(feature_id)
+        if self.element_store:
+            element = self.element_store.get_many([feature]).get(feature)
+            if element and not needs_history(feature.obj_type, element):
+                self.remember_members(feature_id, feature.obj_type, element)
+                return (latest_version_attribs(element), True)
+        response = self.api_get(
+            f"{feature.obj_type}/{feature.obj_id}/history.json", app_version
         )
-        # Raises exceptions for non-successful status codes
-        response.raise_for_status()
 
         loaded_response = response.json()
         latest_version = loaded_response["elements"][-1]
-        element_attribs = {
-            "user_new": latest_version["user"],
-            "changeset_new": str(latest_version["changeset"]),
-            "version_new": str(latest_version["version"]),
-            "timestamp_new": latest_version["timestamp"],
-        }
         if not latest_version.get("visible", True):
-            # The most recent way version has the way deleted
+            # The most recent version has the feature deleted
             prior_version_num = latest_version["version"] - 1
-            try:
-                prior_version = next(
+            prior_version = next(
+                (
                     i
                     for i in loaded_response["elements"]
                     if i["version"] == prior_version_num
-                )
-            except IndexError:
+                ),
                 # Prior version doesn't exist for some reason, possibly redaction
-                pass
+                {},
+            )
+            if "nodes" in prior_version:
+                latest_version = {
+                    **latest_version,
+                    "nodes": prior_version["nodes"],
+                }
+        if self.element_store:
+            self.element_store.put_many(feature.obj_type, [latest_version])
+        self.remember_members(feature_id, feature.obj_type, latest_version)
+        return (latest_version_attribs(latest_version), False)
+
+    def remember_members(
+        self, feature_id, feature_type: str, element: Mapping
+    ) -> None:
+        """
+        Saves the last members of a deleted way
+        for later use in detecting splits/merges
+        """
+        if (
+            feature_type == "way"
+            and not element.get("visible", True)
+            and "nodes" in element
+        ):
+            self.deleted_way_members[feature_id] = element["nodes"]
+
+    def fetch_latest_versions(
+        self,
+        feature_type: str,
+        feature_id_nums: list[str],
+        app_version: str = "",
+    ) -> dict[str, dict]:
+        """
+        Gets the latest version of many features of one type in one request,
+        keyed by id number, and keeps them in the element store.
+        Deleted features are included as invisible
+        """
+        ids = ",".join(feature_id_nums)
+        response = self.api_get(
+            f"{feature_type}s.json?{feature_type}s={ids}", app_version
+        )
+        elements = response.json()["elements"]
+        if self.element_store:
+            # Deleted ways are stored once their last nodes are known
+            self.element_store.put_many(
+                feature_type,
+                [
+                    element
+                    for element in elements
+                    if not needs_history(feature_type, element)
+                ],
+            )
+        return {str(element["id"]): element for element in elements}
+
+    def api_get(self, path: str, app_version: str = "") -> requests.Response:
+        """
+        Gets a path of the OSM API within the rate limit,
+        retrying while the server rate limits the request, unless it asks
+        for a longer wait than API_MAX_RETRY_AFTER
+        """
+        if app_version:
+            app_version = f" {app_version}".rstrip()
+        for retry in itertools.count():
+            self.api_limiter.acquire()
+            response = self.session.get(
+                f"{OSM_API_URL}{path}",
+                timeout=5,
+                headers={
+                    "User-Agent": f"Kaart Chameleon{app_version}",
+                    "From": "dev@kaart.com",
+                },
+            )
+            if response.status_code != 429 or retry >= API_RETRIES:
+                break
+            wait = retry_after(response)
+            if wait > API_MAX_RETRY_AFTER:
+                # Waiting would hold up every thread, and cancelling
+                raise requests.HTTPError(
+                    f"Rate limited by the OSM API for {wait:.0f} seconds",
+                    response=response,
+                )
+            # Every thread holds off until the server is ready again
+            self.api_limiter.pause(wait)
+        # Raises exceptions for non-successful status codes
+        response.raise_for_status()
+        return response
+
+    def check_features_on_api(
+        self,
+        feature_ids: Iterable,
+        app_version: str = "",
+        max_in_flight: int = API_MAX_IN_FLIGHT,
+    ) -> Generator[ApiCheck, None, None]:
+        """
+        Checks features on the OSM API with up to max_in_flight requests
+        at once, within the rate of self.api_limiter.
+
+        Features in the element store are answered from it without any
+        request. The latest versions of the rest are fetched API_BATCH_SIZE
+        features at a time, which is all that's needed for features that are
+        still visible (dropped) and for deleted nodes and relations. Only
+        deleted ways, whose last members are needed, and features of batches
+        that failed get their full history checked one by one.
+
+        Yields an ApiCheck for each feature as it finishes. Errors are
+        yielded rather than raised, so one feature can't end the others.
+        If the generator is closed, requests not yet started are cancelled
+        and the running ones are waited for
+        """
+        features = {
+            feature_id: feature_type_and_number(feature_id)
+            for feature_id in feature_ids
+        }
+        stored = (
+            self.element_store.get_many(features.values())
+            if self.element_store
+            else {}
+        )
+        unknown = []
+        histories = []
+        for feature_id, feature in features.items():
+            element = stored.get(feature)
+            if element is None:
+                unknown.append(feature_id)
+            elif needs_history(feature.obj_type, element):
+                histories.append(feature_id)
             else:
-                # Save last members of the deleted way
-                # for later use in detecting splits/merges
-                if feature_type == "way":
-                    self.deleted_way_members[feature_id] = prior_version["nodes"]
-        else:
-            element_attribs["action"] = "dropped"
-        return (element_attribs, getattr(response, "from_cache", False))
+                self.remember_members(feature_id, feature.obj_type, element)
+                yield ApiCheck(
+                    feature_id, latest_version_attribs(element), True, None
+                )
+        batches = api_batches(unknown)
+        executor = ThreadPoolExecutor(max_in_flight)
+        pending = {}
+
+        def submit(count: int) -> None:
+            for _ in range(count):
+                if histories:
+                    feature_id = histories.pop(0)
+                    future = executor.submit(
+                        self.check_feature_on_api, feature_id, app_version
+                    )
+                    pending[future] = (None, [feature_id])
+                elif batch := next(batches, None):
+                    feature_type, batch_ids = batch
+                    future = executor.submit(
+                        self.fetch_latest_versions,
+                        feature_type,
+                        [feature_id_num for _, feature_id_num in batch_ids],
+                        app_version,
+                    )
+                    pending[future] = batch
+                else:
+                    return
+
+        try:
+            # Only a few more than can run are queued, so cancelling is quick
+            submit(2 * max_in_flight)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    feature_type, batch_ids = pending.pop(future)
+                    if feature_type is None:
+                        yield api_check(batch_ids[0], future)
+                        continue
+                    try:
+                        elements = future.result()
+                    except Exception as e:
+                        if is_rate_limited(e):
+                            for feature_id, _ in batch_ids:
+                                yield ApiCheck(feature_id, {}, False, e)
+                        else:
+                            # Falls back to checking each feature on its own
+                            histories += [fid for fid, _ in batch_ids]
+                        continue
+                    for feature_id, feature_id_num in batch_ids:
+                        element = elements.get(feature_id_num)
+                        if element is None or needs_history(
+                            feature_type, element
+                        ):
+                            histories.append(feature_id)
+                            continue
+                        yield ApiCheck(
+                            feature_id,
+                            latest_version_attribs(element),
+                            False,
+                            None,
+                        )
+                submit(2 * max_in_flight - len(pending))
+        finally:
+            # Running checks still write the members of deleted ways and the
+            # element store, so they finish before the caller goes on
+            executor.shutdown(wait=True, cancel_futures=True)
 
     def write_excel(self, file_name: Path | str):
         with pd.ExcelWriter(file_name, engine="xlsxwriter") as writer:
             for result in sorted(self, key=len, reverse=True):
+                result = result.formatted()
                 # Points at first cell (blank) of last column written
                 # Set before adding the other columns
                 extra_column_start = len(result.columns) + 1
@@ -598,134 +1247,351 @@ class ChameleonDataFrameSet(set):
         Manages and tracks the progress of Overpass query or queries
         """
 
-        request_interval = 5  # Time to wait between queries
+        # Time to wait for a slot when the server doesn't say when one frees up
+        request_interval = 5
 
-        def __init__(self, parent):
+        def __init__(
+            self,
+            parent,
+            timeout: int = OVERPASS_TIMEOUT,
+            endpoint: str = OVERPASS_ENDPOINT,
+        ):
             self.parent = parent
-            self.timeout = OVERPASS_TIMEOUT
-            self.api = overpass.API(timeout=self.timeout)
+            self.timeout = timeout
+            self.api = overpass.API(timeout=self.timeout, endpoint=endpoint)
             self.queries_completed = 0
             self._response_features = []
+            keys = parent.overpass_keys
+            self.geometry_store = parent.geometry_store
+            self.stored_versions = pd.Series(dtype="Int64")
+            if self.geometry_store:
+                # Only features whose current version isn't stored are fetched
+                versions = parent.overpass_versions
+                stored = self.geometry_store.find(versions)
+                self.stored_versions = versions[stored]
+                keys = keys[~np.isin(keys, stored)]
+            # Each feature type's ids are cut into pages as they're sent,
+            # at a length that adapts to how that type's pages went so far
+            self.remaining = ids_by_type(keys)
+            self.page_lengths = {
+                feature_type: parent.page_length
+                for feature_type in self.remaining
+            }
+            # Halves of pages that failed, sent before any new pages
+            self.retries = deque()
+            self.in_flight = {}
 
-        def get(self) -> Generator[None, None, None]:
-            sleeptime = 0
-            for query in self.parent.overpass_query_pages:
-                self.overpass_start_time = (
-                    datetime.now().astimezone() + timedelta(seconds=sleeptime)
-                )
-                self.overpass_timeout_time = (
-                    self.overpass_start_time + timedelta(seconds=self.timeout)
+        def get(
+            self, on_features: Callable[[list[dict]], None] | None = None
+        ) -> Generator[None, None, None]:
+            """
+            Fetches every query page, keeping as many in flight as the server
+            has free slots for. The slot status is read once up front, then
+            again only when a page finishes or a taken slot should be free.
+            Pages that time out are split in half and sent again.
+            Yields whenever the progress changes
+
+            on_features: given the features of each page as it arrives,
+            and stored features a page at a time. By default they're
+            collected for the geojson property
+            """
+            self.on_features = on_features or self._response_features.extend
+            for start in range(
+                0, len(self.stored_versions), self.parent.page_length
+            ):
+                self.on_features(
+                    list(
+                        self.geometry_store.get_many(
+                            self.stored_versions.iloc[
+                                start : start + self.parent.page_length
+                            ]
+                        ).values()
+                    )
                 )
+            if not self.pages_left:
+                return
+            executor = ThreadPoolExecutor(OVERPASS_MAX_IN_FLIGHT)
+            try:
+                status = self.slot_status()
+                free = free_slots(status, 0)
+                while self.pages_left or self.in_flight:
+                    while self.pages_left and free:
+                        free -= 1
+                        logger.info(
+                            "Making query number %s of %s from Overpass.",
+                            self.queries_completed + len(self.in_flight) + 1,
+                            self.number_of_queries,
+                        )
+                        page = self.next_page()
+                        self.in_flight[
+                            executor.submit(self.fetch_page, *page)
+                        ] = page
+                        self.set_start_time(datetime.now().astimezone())
+                    if not self.in_flight:
+                        # Every slot is taken, wait for the first to free up
+                        sleeptime = self.slot_wait(status)
+                        self.set_start_time(
+                            datetime.now().astimezone()
+                            + timedelta(seconds=sleeptime)
+                        )
+                        yield
+                        time.sleep(sleeptime)
+                        status = self.slot_status()
+                        free = free_slots(status, 0)
+                        continue
+                    yield
+                    done, _ = wait(self.in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.page_done(future, *self.in_flight.pop(future))
+                    logger.info("done")
+                    if self.pages_left:
+                        status = self.slot_status()
+                        free = free_slots(status, len(self.in_flight))
                 yield
-                time.sleep(sleeptime)
-                logger.info(
-                    "Making query number %s of %s from Overpass.",
-                    self.queries_completed + 1,
-                    self.number_of_queries,
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        @property
+        def pages_left(self) -> bool:
+            return bool(self.retries) or any(
+                len(ids) for ids in self.remaining.values()
+            )
+
+        def next_page(self) -> tuple[str, np.ndarray]:
+            """
+            The feature type and ids of the next page to send
+            """
+            if self.retries:
+                return self.retries.popleft()
+            feature_type, ids = next(
+                (feature_type, ids)
+                for feature_type, ids in self.remaining.items()
+                if len(ids)
+            )
+            page_length = self.page_lengths[feature_type]
+            self.remaining[feature_type] = ids[page_length:]
+            return feature_type, ids[:page_length]
+
+        def fetch_page(
+            self, feature_type: str, ids: np.ndarray
+        ) -> tuple[dict, float]:
+            """
+            The response to a page, and how many seconds it took
+            """
+            start = time.monotonic()
+            response = self.api.get(
+                f"{feature_type}(id:{','.join(ids.astype(str))});",
+                verbosity="meta geom",
+                responseformat="geojson",
+            )
+            return response, time.monotonic() - start
+
+        def page_done(
+            self, future: Future, feature_type: str, ids: np.ndarray
+        ) -> None:
+            """
+            Keeps the features of a finished page and adapts the length of
+            later pages of its type, or splits it to be sent again if it
+            timed out
+            """
+            try:
+                response, seconds = future.result()
+            except (
+                overpass.TimeoutError,
+                overpass.ServerLoadError,
+                overpass.ServerRuntimeError,
+            ) as e:
+                if len(ids) == 1:
+                    raise
+                logger.warning(
+                    "A page of %s %ss failed, splitting it: %s",
+                    len(ids),
+                    feature_type,
+                    e,
                 )
-                r = self.api.get(
-                    query,
-                    verbosity="meta geom",
-                    responseformat="geojson",
+                half = len(ids) // 2
+                self.page_lengths[feature_type] = min(
+                    self.page_lengths[feature_type], half
                 )
-                logger.info("done")
-                self.queries_completed += 1
-                self._response_features += r["features"]
-                next_slot_seconds = 0
-                if self.next_query_allowed:
-                    next_slot_seconds = round(
-                        (
-                            self.next_query_allowed - datetime.now().astimezone()
-                        ).total_seconds()
+                self.retries.extendleft(
+                    [(feature_type, ids[half:]), (feature_type, ids[:half])]
+                )
+                return
+            features = response["features"]
+            self.on_features(features)
+            self.queries_completed += 1
+            if self.geometry_store:
+                self.geometry_store.put_many(features)
+            self.page_lengths[feature_type] = adapted_page_length(
+                self.page_lengths[feature_type],
+                len(ids),
+                seconds,
+                geometry_points(features),
+            )
+
+        def set_start_time(self, start_time: datetime) -> None:
+            self.overpass_start_time = start_time
+            self.overpass_timeout_time = self.overpass_start_time + timedelta(
+                seconds=self.timeout
+            )
+
+        def slot_status(self) -> SlotStatus:
+            """
+            Reads the current IP's slots from the server's status endpoint
+            """
+            response = requests.get(
+                self.api.status_url,
+                headers={"User-Agent": self.api.headers["User-Agent"]},
+                timeout=self.request_interval,
+            )
+            response.raise_for_status()
+            return parse_slot_status(response.text)
+
+        def slot_wait(self, status: SlotStatus) -> float:
+            """
+            Seconds until the first taken slot frees up, by the server's clock
+            """
+            if not status.waiting:
+                return self.request_interval
+            return max(
+                (min(status.waiting) - status.current_time).total_seconds(), 1
+            )
+
+        def write_geojson(self, path: Path) -> Generator[None, None, None]:
+            """
+            Fetches every feature like get(), writing each page to a GeoJSON
+            file as it arrives, joined with the features' attributes,
+            so only a page of features is held at a time. The file is written
+            under a temporary name, which replaces path once it's complete
+            """
+            attributes = self.attributes.to_dict("index")
+            partial = path.with_name(f"{path.name}.part")
+            try:
+                with partial.open("w") as output_file:
+                    output_file.write(
+                        '{"type": "FeatureCollection", "features": ['
                     )
-                sleeptime = max(self.request_interval, next_slot_seconds)
+                    separator = ""
+
+                    def write_page(features: list[dict]) -> None:
+                        nonlocal separator
+                        for feature in joined_features(features, attributes):
+                            output_file.write(separator)
+                            geojson.dump(feature, output_file)
+                            separator = ", "
+
+                    yield from self.get(write_page)
+                    output_file.write("]}")
+                partial.replace(path)
+            finally:
+                partial.unlink(missing_ok=True)
 
         @property
         def geojson(self) -> geojson.FeatureCollection:
             if not self.complete:
                 raise RuntimeError
-            response_by_id = {
-                GEOJSON_OSM[i["geometry"]["type"]][0] + str(i["id"]): i
-                for i in self._response_features
-            }
-            agg_functions = {
-                "user": lambda user: ",".join(user.unique()),
-                "timestamp": "max",
-                "version": "max",
-                "changeset": lambda changeset: ",".join(changeset.unique()),
-                "name": lambda changeset: ",".join(changeset.unique()),
-                "highway": lambda changeset: ",".join(changeset.unique()),
-                "old_tag": lambda old_tag: ",".join(old_tag.unique()),
-                "new_tag": lambda new_tag: ",".join(new_tag.unique()),
-                "change_type": ",".join,
-            }
-
-            combined = pd.concat(self.with_mode_column)
-            combined.fillna("", inplace=True)
-            combined = combined.astype(str)
-            combined.reset_index(inplace=True)
-            combined = combined.groupby("id").aggregate(agg_functions)
-
-            columns_to_keep = ["user", "timestamp", "version"]
-            if "changeset" in combined.columns and "osmcha" in combined.columns:
-                columns_to_keep += ["changeset", "osmcha"]
-            columns_to_keep += [
-                "name",
-                "highway",
-                "old_tag",
-                "new_tag",
-                "change_type",
-            ]
-            combined = combined[columns_to_keep]
-
             return geojson.FeatureCollection(
-                [
-                    geojson.Feature(
-                        id=fid,
-                        geometry=response_by_id.get(fid, {}).get("geometry"),
-                        properties=dict(row),
+                list(
+                    joined_features(
+                        self._response_features,
+                        self.attributes.to_dict("index"),
                     )
-                    for fid, row in combined.iterrows()
-                    if response_by_id.get(fid)
-                ]
+                )
             )
 
         @property
-        def complete(self) -> bool:
-            return self.queries_completed >= self.number_of_queries
+        def attributes(self) -> pd.DataFrame:
+            """
+            The properties of each feature in the GeoJSON output, by id,
+            combined from every mode it changed in. Values are joined
+            per feature in the order they first appear, the latest timestamp
+            and version are the greatest of their strings
+            """
+            parts = list(self.with_mode_column)
+            ids = np.concatenate(
+                [part.index.to_numpy(dtype=object) for part in parts]
+                or [np.array([], dtype=object)]
+            )
+            codes, uniques = pd.factorize(ids, sort=True)
+            group_count = len(uniques)
 
-        @property
+            def combined(column: str) -> np.ndarray:
+                return np.concatenate(
+                    [
+                        (
+                            part[column].to_numpy()
+                            if column in part
+                            # Like the missing column of a concatenated frame
+                            else np.full(len(part), "", dtype=object)
+                        )
+                        for part in parts
+                    ]
+                    or [np.array([], dtype=object)]
+                )
+
+            attributes = pd.DataFrame(index=pd.Index(uniques, name="id"))
+            for column in [*GEOJSON_ATTRIBUTES, "change_type"]:
+                if not any(column in part for part in parts):
+                    continue
+                values = combined(column)
+                if column in ("timestamp", "version"):
+                    attributes[column] = max_groups(codes, values, group_count)
+                else:
+                    attributes[column] = join_groups(
+                        codes,
+                        values,
+                        group_count,
+                        unique=column != "change_type",
+                    )
+            return attributes[[*GEOJSON_ATTRIBUTES, "change_type"]]
+
+        @property
+        def complete(self) -> bool:
+            return self.queries_completed >= self.number_of_queries
+
+        @property
         def number_of_queries(self) -> int:
-            return len(self.parent.overpass_query_pages)
+            """
+            Pages done, in flight, and left at the current page lengths,
+            which changes as the page lengths adapt
+            """
+            return (
+                self.queries_completed
+                + len(self.in_flight)
+                + len(self.retries)
+                + sum(
+                    -(-len(ids) // self.page_lengths[feature_type])
+                    for feature_type, ids in self.remaining.items()
+                )
+            )
 
         @property
-        def with_mode_column(self) -> Generator[ChameleonDataFrame, None, None]:
-            # the_cdfs = set()
+        def with_mode_column(self) -> Generator[pd.DataFrame, None, None]:
+            """
+            The columns of each mode's results that go into the GeoJSON
+            properties, written out as strings, with the mode's old and new
+            values as old_tag and new_tag, and the mode as change_type
+            """
             for cdf in self.parent.nondeleted:
-                cdf_copy = cdf.copy()
-                cdf_copy.rename(
-                    columns={
-                        next(
-                            (
-                                name
-                                for name in cdf.columns
-                                if name.startswith("old_")
-                            ),
-                            "old",
-                        ): "old_tag",
-                        next(
-                            (
-                                name
-                                for name in cdf.columns
-                                if name.startswith("new_")
-                            ),
-                            "new",
-                        ): "new_tag",
+                sources = {column: column for column in GEOJSON_ATTRIBUTES}
+                sources["old_tag"] = next(
+                    (name for name in cdf.columns if name.startswith("old_")),
+                    None,
+                )
+                sources["new_tag"] = next(
+                    (name for name in cdf.columns if name.startswith("new_")),
+                    None,
+                )
+                part = pd.DataFrame(
+                    {
+                        column: output_strings(cdf[source])
+                        for column, source in sources.items()
+                        if source in cdf
                     },
-                    inplace=True,
+                    index=cdf.index,
                 )
-                cdf_copy["change_type"] = cdf.chameleon_mode
-                yield cdf_copy
+                part["change_type"] = cdf.chameleon_mode
+                yield part
 
         @property
         def next_query_allowed(self) -> datetime | None:
@@ -734,13 +1600,11 @@ class ChameleonDataFrameSet(set):
             be allowed to make a request.
             If None, the current IP can make a request immediately
             """
-            if self.api.slots_available:
+            status = self.slot_status()
+            if status.available:
                 return None
             try:
-                return min(
-                    *self.api.slots_waiting,
-                    *self.api.slots_running,
-                )
+                return min(*status.waiting, *status.running)
             except (TypeError, ValueError):
                 return None
 
@@ -776,36 +1640,1405 @@ class ChameleonDataFrameSet(set):
     def nondeleted(self) -> set[ChameleonDataFrame]:
         return {i for i in self if i.chameleon_mode != "deleted"}
 
+    @property
+    def overpass_keys(self) -> np.ndarray:
+        """
+        The keys of every feature whose geometry comes from Overpass.
+        Relations have no geometry of their own to fetch
+        """
+        keys = np.unique(
+            np.concatenate(
+                [parse_ids(df.index) for df in self.nondeleted]
+                or [np.array([], dtype=np.int64)]
+            )
+        )
+        return keys[keys >> TYPE_SHIFT != TYPE_ORDER["relation"]]
+
+    @property
+    def overpass_versions(self) -> pd.Series:
+        """
+        The version of each feature in overpass_keys, as of the new file
+        where it's in it
+        """
+        versions = [self.source_data["version"]]
+        # The other features' rows only remain in the special dataframes,
+        # which are never grouped
+        versions += [
+            pd.Series(cdf["version"].array, index=parse_ids(cdf.index))
+            for cdf in self.nondeleted
+            if cdf.chameleon_mode in SPECIAL_MODES
+        ]
+        versions = pd.concat(versions)
+        versions = versions[~versions.index.duplicated()]
+        return versions.reindex(self.overpass_keys)
+
     @property
     def overpass_query_pages(self) -> list[str]:
-        all_ids = sorted(
-            set(itertools.chain(*(df.index for df in self.nondeleted)))
+        return overpass_id_pages(self.overpass_keys, self.page_length)
+
+
+def store_operation(empty: Callable[[], object]) -> Callable:
+    """
+    Keeps a store method from ending the run when SQLite fails,
+    e.g. while another process has the database locked. The error is
+    logged, and from then on the store is left alone and the method
+    gives what empty() returns, as if nothing were stored
+    """
+
+    def decorator(method: Callable) -> Callable:
+        @functools.wraps(method)
+        def operation(self, *args, **kwargs):
+            if self.failed:
+                return empty()
+            try:
+                return method(self, *args, **kwargs)
+            except sqlite3.Error as e:
+                logger.error(
+                    "%s failed, carrying on without it: %s",
+                    type(self).__name__,
+                    e,
+                )
+                self.failed = True
+                return empty()
+
+        return operation
+
+    return decorator
+
+
+class SqliteStore:
+    """
+    An SQLite database shared by threads, which take turns under a lock.
+    Subclasses list the statements that set it up in SCHEMA
+    """
+
+    # Ids per lookup, under SQLite's limit on query parameters
+    CHUNK_SIZE = 500
+    SCHEMA: list[str] = []
+
+    def __init__(self, path: Path) -> None:
+        self.failed = False
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            for statement in self.SCHEMA:
+                self.connection.execute(statement)
+
+    def select_in(
+        self, query: str, ids: list[int], before=(), after=()
+    ) -> list[tuple]:
+        """
+        The rows of a query whose {ids} placeholder is filled with
+        parameters for the ids, run for CHUNK_SIZE ids at a time.
+        The other parameters of the query go before or after the ids
+        """
+        found = []
+        with self.lock:
+            for start in range(0, len(ids), self.CHUNK_SIZE):
+                chunk = ids[start : start + self.CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                found += self.connection.execute(
+                    query.format(ids=placeholders), [*before, *chunk, *after]
+                )
+        return found
+
+
+class ElementStore(SqliteStore):
+    """
+    The latest known state of OSM elements, keyed by type and id, in SQLite.
+    Entries are stored and returned like the elements of the OSM API,
+    deleted ways with the nodes of their last version.
+    Visible elements expire after max_age, deleted ones never do
+    """
+
+    SCHEMA = [
+        """
+        CREATE TABLE IF NOT EXISTS elements (
+            type TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            visible INTEGER NOT NULL,
+            user TEXT,
+            changeset INTEGER,
+            timestamp TEXT,
+            nodes TEXT,
+            fetched REAL NOT NULL,
+            PRIMARY KEY (type, id)
+        ) WITHOUT ROWID
+        """
+    ]
+
+    def __init__(
+        self, path: Path, max_age: timedelta = ELEMENT_STORE_MAX_AGE
+    ) -> None:
+        self.max_age = max_age
+        super().__init__(path)
+
+    @store_operation(dict)
+    def get_many(self, features: Iterable[OsmObj]) -> dict[OsmObj, dict]:
+        """
+        The stored elements of the given features that haven't expired
+        """
+        ids_by_type = {}
+        for feature_type, feature_id_num in features:
+            ids_by_type.setdefault(feature_type, []).append(
+                int(feature_id_num)
+            )
+        fresh_since = time.time() - self.max_age.total_seconds()
+        found = {}
+        for feature_type, type_ids in ids_by_type.items():
+            rows = self.select_in(
+                "SELECT id, version, visible, user, changeset, timestamp, "
+                "nodes FROM elements WHERE type = ? AND id IN ({ids}) "
+                "AND (NOT visible OR fetched >= ?)",
+                type_ids,
+                before=[feature_type],
+                after=[fresh_since],
+            )
+            for row in rows:
+                element = dict(
+                    zip(
+                        (
+                            "id",
+                            "version",
+                            "visible",
+                            "user",
+                            "changeset",
+                            "timestamp",
+                        ),
+                        row,
+                    )
+                )
+                element["visible"] = bool(element["visible"])
+                if row[-1] is not None:
+                    element["nodes"] = json.loads(row[-1])
+                found[OsmObj(feature_type, str(row[0]))] = element
+        return found
+
+    @store_operation(lambda: None)
+    def put_many(self, feature_type: str, elements: Iterable[Mapping]) -> None:
+        """
+        Stores the latest versions of elements of one type,
+        as returned by the OSM API
+        """
+        fetched = time.time()
+        rows = [
+            (
+                feature_type,
+                element["id"],
+                element["version"],
+                element.get("visible", True),
+                element.get("user"),
+                element.get("changeset"),
+                element.get("timestamp"),
+                json.dumps(element["nodes"]) if "nodes" in element else None,
+                fetched,
+            )
+            for element in elements
+        ]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO elements "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+
+class GeometryStore(SqliteStore):
+    """
+    The GeoJSON features Overpass gave for OSM elements, keyed by feature key
+    and version, in SQLite. Once the features take up more than max_size
+    bytes, the least recently used are deleted down to EVICT_TO of it
+    """
+
+    # Leaves room for a few pages before the next eviction
+    EVICT_TO = 0.9
+    SCHEMA = [
+        """
+        CREATE TABLE IF NOT EXISTS geometries (
+            key INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            feature TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            used REAL NOT NULL,
+            PRIMARY KEY (key, version)
+        ) WITHOUT ROWID
+        """,
+        # In the order features are evicted
+        "CREATE INDEX IF NOT EXISTS geometries_used "
+        "ON geometries (used, key, version)",
+        # The total size of the features, kept up to date by triggers
+        "CREATE TABLE IF NOT EXISTS geometries_size (total INTEGER)",
+        "INSERT INTO geometries_size "
+        "SELECT COALESCE(SUM(size), 0) FROM geometries "
+        "WHERE NOT EXISTS (SELECT * FROM geometries_size)",
+        """
+        CREATE TRIGGER IF NOT EXISTS geometries_insert
+        AFTER INSERT ON geometries BEGIN
+            UPDATE geometries_size SET total = total + NEW.size;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS geometries_delete
+        AFTER DELETE ON geometries BEGIN
+            UPDATE geometries_size SET total = total - OLD.size;
+        END
+        """,
+    ]
+
+    def __init__(
+        self, path: Path, max_size: int = GEOMETRY_STORE_SIZE
+    ) -> None:
+        self.max_size = max_size
+        super().__init__(path)
+
+    @store_operation(dict)
+    def get_many(self, versions: pd.Series) -> dict[int, dict]:
+        """
+        The stored features at the given versions, which are indexed
+        by feature key, and marks them used
+        """
+        rows = self.matching_rows(versions, ["feature"])
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE geometries SET used = ? WHERE key = ? AND version = ?",
+                [(time.time(), key, version) for key, version, _ in rows],
+            )
+        return {key: json.loads(feature) for key, _, feature in rows}
+
+    @store_operation(list)
+    def find(self, versions: pd.Series) -> list[int]:
+        """
+        The keys of the features stored at the given versions,
+        which are indexed by feature key
+        """
+        return [key for key, _ in self.matching_rows(versions, [])]
+
+    def matching_rows(
+        self, versions: pd.Series, columns: list[str]
+    ) -> list[tuple]:
+        """
+        The key, version and given columns of the rows stored at the given
+        versions, looked up by key a chunk at a time
+        """
+        versions = versions.dropna()
+        versions = dict(
+            zip(
+                versions.index.to_numpy(np.int64).tolist(),
+                versions.to_numpy(np.int64).tolist(),
+            )
         )
-        query_pages = []
-        for page in pager(all_ids, self.page_length):
-            feature_ids = separate_ids_by_feature_type(page)
-            if query_page := ";".join(
-                f"{ftype}(id:{','.join(sorted(fid))})"
-                for ftype, fid in feature_ids.items()
-                if ftype != "relation" and fid
-            ):
-                # Relations will create empty query pages, skip those
-                query_pages.append(query_page)
-        return query_pages
+        selected = ", ".join(["key", "version", *columns])
+        rows = self.select_in(
+            f"SELECT {selected} FROM geometries WHERE key IN ({{ids}})",
+            list(versions),
+        )
+        return [row for row in rows if versions[row[0]] == row[1]]
+
+    @store_operation(lambda: None)
+    def put_many(self, features: Iterable[Mapping]) -> None:
+        """
+        Stores GeoJSON features from Overpass, then evicts
+        the least recently used if the store is past max_size
+        """
+        used = time.time()
+        rows = []
+        for feature in features:
+            properties = feature.get("properties", {})
+            feature_type = properties.get("type") or GEOJSON_OSM.get(
+                (feature.get("geometry") or {}).get("type")
+            )
+            feature_id = feature.get("id", properties.get("id"))
+            if "version" not in properties or feature_id is None:
+                continue
+            text = json.dumps(feature)
+            rows.append(
+                (
+                    int(pack_ids([feature_type], [feature_id])[0]),
+                    properties["version"],
+                    text,
+                    len(text),
+                    used,
+                )
+            )
+        with self.lock, self.connection:
+            # A feature at a version never changes, so a stored one is only
+            # marked used, and only new ones add to the total size
+            self.connection.executemany(
+                "INSERT INTO geometries VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (key, version) "
+                "DO UPDATE SET used = excluded.used",
+                rows,
+            )
+            (total,) = self.connection.execute(
+                "SELECT total FROM geometries_size"
+            ).fetchone()
+            if total <= self.max_size:
+                return
+            # Features written together are used at the same time,
+            # so ties are broken by key to evict only some of them
+            self.connection.execute(
+                """
+                DELETE FROM geometries WHERE (key, version) IN (
+                    SELECT key, version FROM (
+                        SELECT key, version, size, SUM(size) OVER (
+                            ORDER BY used, key, version
+                        ) AS freed
+                        FROM geometries
+                    )
+                    WHERE freed - size < ?
+                )
+                """,
+                [total - self.EVICT_TO * self.max_size],
+            )
+
+
+class TokenBucket:
+    """
+    Thread-safe rate limiter, allowing bursts of up to capacity calls
+    and refilling at rate calls per second
+    """
+
+    def __init__(self, rate: float, capacity: int = 1) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Blocks until a call is allowed
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate,
+                )
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(
+                    self.paused_until - now, (1 - self.tokens) / self.rate
+                )
+            time.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Allows no calls for the given time, then starts from an empty bucket
+        """
+        with self.lock:
+            self.paused_until = max(
+                self.paused_until, time.monotonic() + seconds
+            )
+            self.tokens = 0
+
+
+def overpass_id_pages(
+    keys: Iterable[int],
+    page_length: int,
+    feature_types: Iterable[str] = TYPE_NAMES,
+) -> list[str]:
+    """
+    Overpass queries for the features of the given keys, up to page_length
+    features each. Features of types not in feature_types are left out
+    """
+    keys = np.unique(np.asarray(keys, dtype=np.int64))
+    type_codes = [TYPE_ORDER[feature_type] for feature_type in feature_types]
+    keys = keys[np.isin(keys >> TYPE_SHIFT, type_codes)]
+    query_pages = []
+    for start in range(0, len(keys), page_length):
+        page = keys[start : start + page_length]
+        # A union, so the output statement covers every type in the page
+        statements = "".join(
+            f"{ftype}(id:{','.join(fid.astype(str))});"
+            for ftype, fid in ids_by_type(page).items()
+        )
+        query_pages.append(f"({statements});")
+    return query_pages
+
+
+def match_successors(
+    deleted_members: Mapping[int, Iterable[int]],
+    way_nodes: Mapping[int, Iterable[int]],
+) -> pd.DataFrame:
+    """
+    Matches deleted ways, by their last nodes, with the current ways that
+    took those nodes over, through an index from segment to current ways.
+    A current way only succeeds a deleted way if they share a segment
+    between two consecutive nodes, as ways that merely meet or cross it,
+    even more than once like a loop road, share only separate nodes.
+    The shared segments of a deleted way must cover
+    SUCCESSOR_MIN_COVERAGE of its nodes.
+
+    Returns the action, split if the nodes went to more than one way or
+    merged if to one, and the ids of the successors, for each matched key
+    """
+    deleted = way_segments(deleted_members)
+    current = way_segments(way_nodes).rename(columns={"way": "successor"})
+    # The join looks each deleted segment up in the index of current ways
+    shared = deleted.merge(current, on=["start", "end"])
+    covered = pd.concat(
+        [
+            shared[["way", end]].rename(columns={end: "node"})
+            for end in ("start", "end")
+        ]
+    ).drop_duplicates()
+    node_counts = pd.Series(
+        [len(set(nodes)) for nodes in deleted_members.values()],
+        index=np.fromiter(deleted_members, np.int64, len(deleted_members)),
+    )
+    coverage = covered.groupby("way").size() / node_counts
+    shared = shared[
+        shared["way"].isin(coverage.index[coverage >= SUCCESSOR_MIN_COVERAGE])
+    ]
+    successors = shared.drop_duplicates(["way", "successor"])
+    successors = successors.sort_values(["way", "successor"])
+    grouped = pd.Series(
+        render_ids(successors["successor"]), index=successors["way"]
+    ).groupby(level=0)
+    successors = pd.DataFrame(
+        {"successors": grouped.agg(",".join), "count": grouped.size()}
+    )
+    successors["action"] = np.where(
+        successors.pop("count") > 1, "split", "merged"
+    )
+    return successors
+
+
+def way_segments(ways: Mapping[int, Iterable[int]]) -> pd.DataFrame:
+    """
+    A row for each distinct segment between consecutive nodes of each way,
+    with the lower node id first so that both directions match
+    """
+    nodes = [
+        np.asarray(way_nodes, dtype=np.int64) for way_nodes in ways.values()
+    ]
+    empty = [np.array([], dtype=np.int64)]
+    starts = np.concatenate([way_nodes[:-1] for way_nodes in nodes] or empty)
+    ends = np.concatenate([way_nodes[1:] for way_nodes in nodes] or empty)
+    return pd.DataFrame(
+        {
+            "way": np.repeat(
+                np.fromiter(ways, np.int64, len(ways)),
+                [max(len(way_nodes) - 1, 0) for way_nodes in nodes],
+            ),
+            "start": np.minimum(starts, ends),
+            "end": np.maximum(starts, ends),
+        }
+    ).drop_duplicates()
+
+
+def output_strings(column: pd.Series) -> np.ndarray:
+    """
+    The values of a column written out as in output files,
+    with missing values as empty strings
+    """
+    if isinstance(column.dtype, pd.DatetimeTZDtype):
+        column = column.dt.strftime("%Y-%m-%d")
+    elif isinstance(column.dtype, pd.Int64Dtype):
+        column = column.astype("string")
+    return column.astype(object).fillna("").astype(str).to_numpy(dtype=object)
+
+
+def overpass_feature_id(feature: Mapping) -> str:
+    """
+    The id string, like "w12345678", of a GeoJSON feature from Overpass
+    """
+    feature_id = feature.get("id", feature.get("properties", {}).get("id"))
+    return GEOJSON_OSM[feature["geometry"]["type"]][0] + str(feature_id)
+
+
+def joined_features(
+    features: Iterable[Mapping], attributes: Mapping[str, Mapping]
+) -> Generator[geojson.Feature, None, None]:
+    """
+    The features from Overpass that have attributes,
+    with those attributes as their properties
+    """
+    for feature in features:
+        if feature.get("geometry") is None:
+            continue
+        feature_id = overpass_feature_id(feature)
+        if feature_id in attributes:
+            yield geojson.Feature(
+                id=feature_id,
+                geometry=feature["geometry"],
+                properties=attributes[feature_id],
+            )
+
+
+def adapted_page_length(
+    page_length: int, features: int, seconds: float, points: int
+) -> int:
+    """
+    The length of the next page of a feature type, after a page of the given
+    number of features took the given seconds and had that many geometry
+    points. Aims for OVERPASS_PAGE_SECONDS and at most OVERPASS_PAGE_POINTS,
+    growing at most twofold per page
+    """
+    by_time = features * OVERPASS_PAGE_SECONDS / max(seconds, 1e-3)
+    by_points = features * OVERPASS_PAGE_POINTS / max(points, 1)
+    return int(
+        max(
+            min(by_time, by_points, 2 * page_length, OVERPASS_MAX_PAGE_LENGTH),
+            1,
+        )
+    )
+
+
+def geometry_points(features: Iterable[Mapping]) -> int:
+    """
+    The number of coordinate pairs in the geometries of GeoJSON features
+    """
+
+    def count(coordinates: list) -> int:
+        if coordinates and isinstance(coordinates[0], (int, float)):
+            return 1
+        return sum(map(count, coordinates))
+
+    return sum(
+        count(feature["geometry"]["coordinates"])
+        for feature in features
+        if feature.get("geometry")
+    )
+
+
+def free_slots(status: SlotStatus, in_flight: int) -> int:
+    """
+    How many more queries can be sent to an Overpass server with the given
+    slot status while in_flight of ours are running. The server's count of
+    free slots may not include queries sent just before it was read
+    """
+    if not status.rate_limit:
+        return max(OVERPASS_MAX_IN_FLIGHT - in_flight, 0)
+    return max(min(status.available, status.rate_limit - in_flight), 0)
+
+
+def parse_slot_status(text: str) -> SlotStatus:
+    """
+    Reads the text of the Overpass status endpoint. Waiting slots are the
+    times taken slots free up, running slots the times queries started
+    """
+
+    def parse_time(timestamp: str) -> datetime:
+        return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S%z")
+
+    current_time = re.search(r"^Current time: (\S+)", text, re.M)
+    rate_limit = re.search(r"^Rate limit: (\d+)", text, re.M)
+    available = re.search(r"^(\d+) slots? available now", text, re.M)
+    _, _, running_queries = text.partition("Currently running queries")
+    return SlotStatus(
+        current_time=(
+            parse_time(current_time[1])
+            if current_time
+            else datetime.now(timezone.utc)
+        ),
+        rate_limit=int(rate_limit[1]) if rate_limit else 0,
+        available=int(available[1]) if available else 0,
+        waiting=tuple(
+            map(
+                parse_time,
+                re.findall(r"^Slot available after: (\S+),", text, re.M),
+            )
+        ),
+        running=tuple(
+            parse_time(fields[3])
+            for line in running_queries.splitlines()[1:]
+            if len(fields := line.split()) >= 4
+        ),
+    )
+
+
+def api_batches(
+    feature_ids: Iterable,
+) -> Generator[tuple[str, list[tuple]], None, None]:
+    """
+    Splits feature ids into batches of one type for the multi-fetch endpoints,
+    each a list of (feature id, id number) pairs
+    """
+    by_type = {}
+    for feature_id in feature_ids:
+        feature_type, feature_id_num = feature_type_and_number(feature_id)
+        by_type.setdefault(feature_type, []).append(
+            (feature_id, feature_id_num)
+        )
+    for feature_type, type_ids in by_type.items():
+        for start in range(0, len(type_ids), API_BATCH_SIZE):
+            yield feature_type, type_ids[start : start + API_BATCH_SIZE]
+
+
+def api_check(feature_id, future: Future) -> ApiCheck:
+    """
+    The ApiCheck for a finished check_feature_on_api call
+    """
+    try:
+        element_attribs, from_cache = future.result()
+    except Exception as e:
+        return ApiCheck(feature_id, {}, False, e)
+    return ApiCheck(feature_id, element_attribs, from_cache, None)
+
+
+def is_rate_limited(error: Exception) -> bool:
+    return (
+        isinstance(error, requests.HTTPError)
+        and error.response is not None
+        and error.response.status_code == 429
+    )
+
+
+def needs_history(feature_type: str, element: Mapping) -> bool:
+    """
+    Whether a feature's history is needed to know more than its latest version
+    says, which is only the last nodes of a deleted way
+    """
+    return (
+        feature_type == "way"
+        and not element.get("visible", True)
+        and "nodes" not in element
+    )
+
+
+def latest_version_attribs(element: Mapping) -> dict[str, str]:
+    """
+    The attributes source_data is updated with from the latest version of a
+    feature on the OSM API. Features that weren't deleted were only dropped
+    """
+    element_attribs = {
+        "user_new": element["user"],
+        "changeset_new": str(element["changeset"]),
+        "version_new": str(element["version"]),
+        "timestamp_new": element["timestamp"],
+    }
+    if element.get("visible", True):
+        element_attribs["action"] = "dropped"
+    return element_attribs
+
+
+def retry_after(response: requests.Response) -> float:
+    """
+    Seconds to wait according to a response's Retry-After header,
+    which is either a number of seconds or an HTTP date
+    """
+    value = response.headers.get("Retry-After", "")
+    with suppress(ValueError):
+        return max(float(value), 0)
+    with suppress(TypeError, ValueError):
+        retry_at = parsedate_to_datetime(value)
+        return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+    return API_RETRY_AFTER
+
+
+def join_snapshots(old_df: pd.DataFrame, new_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Outer joins two snapshots indexed by feature key,
+    and tags each row with the action that happened between them
+    """
+    # Used to indicate which sheet(s) each row came from post-join
+    old_df["present"] = new_df["present"] = True
+
+    merged = old_df.join(new_df, how="outer", lsuffix="_old", rsuffix="_new")
+    merged["present_old"].fillna(False, inplace=True)
+    merged["present_new"].fillna(False, inplace=True)
+
+    merged.columns = merged.columns.map(merged_column_name)
+
+    try:
+        merged.loc[
+            merged.present_old & merged.present_new,
+            "action",
+        ] = "modified"
+        merged.loc[
+            merged.present_old & ~merged.present_new,
+            "action",
+        ] = "deleted"
+        merged.loc[
+            ~merged.present_old & merged.present_new,
+            "action",
+        ] = "new"
+    except ValueError:
+        # No change for this mode, add a placeholder column
+        merged["action"] = np.nan
+    return merged
+
+
+def unchanged_rows(
+    merged: pd.DataFrame, modes: Iterable[str] | None
+) -> np.ndarray:
+    """
+    Which modified features of joined snapshots have the same values
+    in both files for every given mode, or in every column if modes is None,
+    so they can't show up in any of the modes' results
+    """
+    if modes is None:
+        columns = [
+            column.removesuffix("_old")
+            for column in merged.columns
+            if column.endswith("_old") and column != "present_old"
+        ]
+    else:
+        columns = [merged_column_name(mode) for mode in modes]
+    unchanged = (merged["action"] == "modified").to_numpy()
+    for column in columns:
+        # Modes the files don't both have can't be queried
+        with suppress(KeyError):
+            unchanged &= ~changed(
+                merged[f"{column}_old"], merged[f"{column}_new"]
+            ).to_numpy()
+    return unchanged
+
+
+def merged_column_name(column: str) -> str:
+    """
+    The name an input column gets once the files are merged
+    """
+    # Eliminate special chars that mess pandas up, and whitespace
+    return column.replace("@", "").replace(":", "_").strip()
+
+
+def merged_columns(
+    columns: Iterable[str], input_columns: set[str] | None
+) -> list[str]:
+    """
+    The merged columns that come from the given input columns,
+    along with the ones the merge adds.
+    All columns if input_columns is None
+    """
+    if input_columns is None:
+        return list(columns)
+    wanted = {merged_column_name(column) for column in input_columns}
+    return [
+        column
+        for column in columns
+        if strip_column_suffix(column) in wanted | {"present", "action"}
+    ]
+
+
+def evict_merge_cache(keep: Path) -> None:
+    """
+    Deletes the least recently used merge cache entries
+    until the cache fits in MERGE_CACHE_SIZE
+    """
+    entries = []
+    for entry in keep.parent.glob("*.feather"):
+        with suppress(FileNotFoundError):
+            entries.append((entry.stat(), entry))
+    total_size = 0
+    for stat, entry in sorted(
+        entries, key=lambda item: item[0].st_mtime, reverse=True
+    ):
+        total_size += stat.st_size
+        if total_size > MERGE_CACHE_SIZE and entry != keep:
+            logger.debug("Evicting %s from the merge cache", entry)
+            entry.unlink(missing_ok=True)
+
+
+def finish_merge(merged: pd.DataFrame) -> pd.DataFrame:
+    """
+    Encodes the tag pairs and adds the typed metadata columns,
+    once the whole file is merged so that every part shares categories
+    """
+    return add_metadata_columns(encode_tag_pairs(merged))
+
+
+def add_metadata_columns(merged: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds typed user, timestamp, version and changeset columns,
+    with the new value where there is one, otherwise the old value.
+    The changeset is only the new one, deleted features have none
+    """
+    merged["user"] = coalesce(merged, "user")
+    merged["timestamp"] = pd.to_datetime(
+        coalesce(merged, "timestamp"), utc=True
+    )
+    merged["version"] = coalesce(merged, "version").astype("Int64")
+    # Either both csvs had changeset columns, one of them did, or neither
+    for changeset_column in ("changeset_new", "changeset"):
+        if changeset_column in merged:
+            merged["changeset"] = merged[changeset_column].astype("Int64")
+            break
+    return merged
+
+
+def encode_tag_pairs(merged: pd.DataFrame) -> pd.DataFrame:
+    """
+    Encodes each pair of old and new tag columns, and the user columns,
+    as categoricals over one set of categories shared by the pair,
+    so that comparing them only compares integer codes
+    """
+    for old_column in merged.columns:
+        column = old_column.removesuffix("_old")
+        new_column = f"{column}_new"
+        if (
+            column == old_column
+            or column in UNENCODED_COLUMNS
+            or new_column not in merged
+        ):
+            continue
+        codes, categories = pd.factorize(
+            pd.concat([merged[old_column], merged[new_column]])
+        )
+        # Categories are few, so Python strings cost little
+        # and don't depend on the CSV engine
+        shared = pd.CategoricalDtype(pd.Index(categories, dtype=object))
+        merged[old_column] = pd.Categorical.from_codes(
+            codes[: len(merged)], dtype=shared
+        )
+        merged[new_column] = pd.Categorical.from_codes(
+            codes[len(merged) :], dtype=shared
+        )
+    return merged
+
+
+def group_keys(values: pd.Series) -> np.ndarray:
+    """
+    Sorted integer codes for the values of a grouping column,
+    with missing values sorted last instead of left out
+    """
+    codes, uniques = pd.factorize(values, sort=True)
+    codes[codes < 0] = len(uniques)
+    return codes
+
+
+def join_groups(
+    codes: np.ndarray, values: Iterable, group_count: int, unique: bool = True
+) -> np.ndarray:
+    """
+    Joins the distinct values of each group with commas, in the order they
+    first appear, or every value if not unique. Missing values are left out,
+    so groups without any values get an empty string
+    """
+    value_codes, uniques = pd.factorize(values)
+    pairs = pd.DataFrame({"group": codes, "value": value_codes})
+    pairs = pairs[pairs["value"] >= 0]
+    if unique:
+        pairs = pairs.drop_duplicates()
+    pairs = pairs.sort_values("group", kind="stable")
+    groups = pairs["group"].to_numpy()
+    strings = np.asarray(uniques.astype(str), dtype=object)
+    strings = strings[pairs["value"].to_numpy()]
+
+    starts = np.flatnonzero(np.diff(groups, prepend=-1))
+    ends = np.append(starts[1:], len(groups))
+    joined = np.full(group_count, "", dtype=object)
+    joined[groups[starts]] = [
+        ",".join(strings[start:end]) for start, end in zip(starts, ends)
+    ]
+    return joined
+
+
+def max_groups(
+    codes: np.ndarray, values: Iterable, group_count: int
+) -> np.ndarray:
+    """
+    The greatest value of each group, comparing the positions of the values
+    among all of them sorted once, rather than the values of each group
+    """
+    value_codes, uniques = pd.factorize(values, sort=True)
+    greatest = (
+        pd.Series(value_codes)
+        .groupby(codes)
+        .max()
+        .reindex(range(group_count), fill_value=-1)
+        .to_numpy()
+    )
+    # Groups without values get a missing value
+    return np.append(np.asarray(uniques, dtype=object), None)[greatest]
+
+
+def compile_filters(config: Mapping) -> list[FilterRule]:
+    """
+    Turns the filter settings of a config into rules, once per run.
+    The routing rules only apply if anything other than ignored modes is set.
+    User-defined rules under "filter_rules" take the same form as
+    DEFAULT_FILTER_RULES and apply after them
+    """
+    if not set(config) - {"ignored_modes"}:
+        return []
+    rule_configs = [
+        *DEFAULT_FILTER_RULES,
+        {"exclude_users": config.get("user_whitelist", [])},
+        {
+            "modes": ["highway"],
+            "highway_step_change": config.get("highway_step_change", 0),
+            "always_include": config.get("always_include", []),
+            "tracks_are_pedestrian": config.get(
+                "tracks_are_pedestrian", False
+            ),
+        },
+        *config.get("filter_rules", []),
+    ]
+    return [compile_filter(rule_config) for rule_config in rule_configs]
+
+
+def compile_filter(rule_config: Mapping) -> FilterRule:
+    """
+    Builds one rule, which keeps the changes that pass all of its settings:
+    require_any: at least one of these columns has a value
+    ignore_values: the old or new value isn't in this list (null for missing)
+    feature_types: the feature is one of these types
+    exclude_users: the last user isn't one of these
+    highway_step_change: the highway class changed by at least this much,
+        unless it changed to or from one in always_include.
+        tracks_are_pedestrian scores tracks with paths instead of roads
+    """
+    rule_config = dict(rule_config)
+    modes = rule_config.pop("modes", None)
+    masks = []
+    columns = set()
+    scores = None
+
+    if required := rule_config.pop("require_any", None):
+        columns.update(required)
+        required = [merged_column_name(column) for column in required]
+
+        def require_any(changes: pd.DataFrame) -> np.ndarray:
+            # Columns the files don't have have no values
+            return np.logical_or.reduce(
+                [
+                    changes[column].notna().to_numpy()
+                    if column in changes
+                    else np.zeros(len(changes), dtype=bool)
+                    for column in required
+                ]
+            )
+
+        masks.append(require_any)
+
+    if "ignore_values" in rule_config:
+        ignored = rule_config.pop("ignore_values")
+        values = [value for value in ignored if value is not None]
+        ignore_missing = len(values) < len(ignored)
+
+        def is_ignored(column: pd.Series) -> np.ndarray:
+            ignored = column.isin(values).to_numpy()
+            if ignore_missing:
+                ignored |= column.isna().to_numpy()
+            return ignored
+
+        def ignore_values(changes: ChameleonDataFrame) -> np.ndarray:
+            mode = changes.chameleon_mode_cleaned
+            return ~(
+                is_ignored(changes[f"old_{mode}"])
+                & is_ignored(changes[f"new_{mode}"])
+            )
+
+        masks.append(ignore_values)
+
+    if "feature_types" in rule_config:
+        type_bits = [
+            TYPE_ORDER[feature_type]
+            for feature_type in rule_config.pop("feature_types")
+        ]
+
+        def feature_types(changes: pd.DataFrame) -> np.ndarray:
+            keys = changes.index.to_numpy(dtype=np.int64)
+            return np.isin(keys >> TYPE_SHIFT, type_bits)
+
+        masks.append(feature_types)
+
+    if users := rule_config.pop("exclude_users", None):
+
+        def exclude_users(changes: pd.DataFrame) -> np.ndarray:
+            return ~changes["user"].isin(users).to_numpy()
+
+        masks.append(exclude_users)
+
+    if "highway_step_change" in rule_config:
+        step_change = rule_config.pop("highway_step_change")
+        always_include = rule_config.pop("always_include", [])
+        highway_values = HIGHWAY_VALUES
+        if rule_config.pop("tracks_are_pedestrian", False):
+            highway_values = highway_values | {"track": 7}
+
+        def highway_score(column: pd.Series) -> pd.Series:
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                # Categories these rows don't use would be mapped too
+                column = column.cat.remove_unused_categories()
+            return column.map(highway_values).astype("Int64")
+
+        def highway_change_score(changes: pd.DataFrame) -> pd.Series:
+            return (
+                highway_score(changes["old_highway"])
+                - highway_score(changes["new_highway"])
+            ).abs()
+
+        def highway_step(changes: pd.DataFrame) -> np.ndarray:
+            score = highway_change_score(changes)
+            return (
+                changes["old_highway"].isin(always_include).to_numpy()
+                | changes["new_highway"].isin(always_include).to_numpy()
+                | (score >= step_change).fillna(False).to_numpy(dtype=bool)
+            )
+
+        def scores(changes: pd.DataFrame) -> dict[str, pd.Series]:
+            # Shows how big each change was
+            return {"highway_change_score": highway_change_score(changes)}
+
+        masks.append(highway_step)
+
+    if rule_config:
+        raise ValueError(f"Unknown filter settings: {', '.join(rule_config)}")
+
+    def keep(changes: pd.DataFrame) -> np.ndarray:
+        result = np.ones(len(changes), dtype=bool)
+        for mask in masks:
+            result &= mask(changes)
+        return result
+
+    return FilterRule(
+        None if modes is None else set(modes), keep, frozenset(columns), scores
+    )
+
+
+def rule_columns(rules: Iterable[FilterRule], mode: str) -> set[str]:
+    """
+    The input columns that the rules for a mode read
+    """
+    return set().union(
+        *(
+            rule.columns
+            for rule in rules
+            if rule.modes is None or mode in rule.modes
+        )
+    )
+
+
+def changed(old: pd.Series, new: pd.Series) -> pd.Series:
+    """
+    Whether each feature's value differs between two columns,
+    treating missing values as equal
+    """
+    if isinstance(old.dtype, pd.CategoricalDtype) and old.dtype == new.dtype:
+        return old.cat.codes != new.cat.codes
+    return old.fillna("") != new.fillna("")
+
+
+def select_mode_changes(
+    source_data: pd.DataFrame, modes: list[str], config: Mapping
+) -> dict[str, pd.DataFrame]:
+    """
+    Selects the changes for the special modes and every given mode
+    from the merged data, without grouping or filtering.
+    Modes that can't be selected are left out of the result
+    """
+    results = {}
+    for mode in SPECIAL_MODES - config.get("ignored_modes", set()):
+        results[mode] = pd.DataFrame(
+            ChameleonDataFrame(
+                source_data[source_data["action"].isin(SPECIAL_ACTIONS[mode])],
+                mode=mode,
+                config=config,
+            ).select_changes()
+        )
+    source_data = source_data[~source_data["action"].isin(SEPARATED_ACTIONS)]
+    results.update(
+        select_all_changes(source_data, modes, compile_filters(config))
+    )
+    return results
+
+
+def select_all_changes(
+    source_data: pd.DataFrame,
+    modes: Iterable[str],
+    rules: Iterable[FilterRule] = (),
+) -> dict[str, pd.DataFrame]:
+    """
+    Selects the changes for every given mode in one pass over the merged data.
+    Finds the changed rows of all modes first, then derives the columns that
+    every mode's results have once, for the rows any mode changed.
+    Each mode also gets the columns its filter rules read.
+    Modes without old and new columns are left out
+    """
+    changed_rows = {}
+    for mode in modes:
+        cleaned = merged_column_name(mode)
+        with suppress(KeyError):
+            changed_rows[mode] = changed(
+                source_data[f"{cleaned}_old"], source_data[f"{cleaned}_new"]
+            ).to_numpy()
+    if not changed_rows:
+        return {}
+
+    any_changed = np.logical_or.reduce(list(changed_rows.values()))
+    changes = source_data[any_changed]
+    details = change_details(changes)
+
+    results = {}
+    for mode, rows in changed_rows.items():
+        cleaned = merged_column_name(mode)
+        rows = rows[any_changed]
+        mode_changes = details[rows]
+        if mode in CONTEXT_COLUMNS:
+            mode_changes = mode_changes.drop(columns=mode, errors="ignore")
+        for column in sorted(rule_columns(rules, mode) - {mode}):
+            column = merged_column_name(column)
+            if column not in mode_changes:
+                # Left out if the files don't have it
+                with suppress(KeyError):
+                    mode_changes[column] = coalesce(changes, column)[rows]
+        mode_changes[f"old_{cleaned}"] = changes[f"{cleaned}_old"][rows]
+        mode_changes[f"new_{cleaned}"] = changes[f"{cleaned}_new"][rows]
+        mode_changes["action"] = changes["action"][rows]
+        # Rows that didn't change in this mode have no action
+        results[mode] = mode_changes.dropna(subset=["action"])
+    return results
+
+
+def change_details(changes: pd.DataFrame) -> pd.DataFrame:
+    """
+    The columns every mode's results have, before the mode's own tag,
+    for the given rows of the merged data
+    """
+    details = pd.DataFrame(index=changes.index)
+    details["url"] = josm_urls(changes.index)
+    details["pewu"] = pewu_urls(changes.index)
+    details["user"] = changes["user"]
+    details["timestamp"] = changes["timestamp"]
+    details["version"] = changes["version"]
+    # Only included if at least one csv had a changeset column
+    if "changeset" in changes:
+        details["changeset"] = changes["changeset"]
+        details["osmcha"] = osmcha_urls(changes["changeset"])
+    for column in ("name", "highway", "barrier"):
+        with suppress(KeyError):
+            details[column] = coalesce(changes, column)
+    # Only present once deletions were checked for splits and merges
+    if "successors" in changes:
+        details["successors"] = changes["successors"]
+    return details
+
+
+def coalesce(merged: pd.DataFrame, column: str) -> pd.Series:
+    """
+    The new value of an input column where there is one,
+    otherwise the old value
+    """
+    try:
+        return merged[f"{column}_new"].fillna(merged[f"{column}_old"])
+    except KeyError:
+        # Succeeds if only one csv had the column
+        return merged[column]
+
+
+def read_arrow_snapshot(
+    source: Path | TextIO, columns: set[str] = None
+) -> pd.DataFrame:
+    """
+    Reads an input file with the multithreaded Arrow reader,
+    keeping every column as Arrow-backed strings
+
+    columns: if given, only these columns are read
+    """
+    header = snapshot_header(source)
+    if not isinstance(source, Path):
+        # Arrow reads bytes, so go around any text layer
+        source = getattr(source, "buffer", source)
+    table = pyarrow.csv.read_csv(
+        source,
+        parse_options=pyarrow.csv.ParseOptions(delimiter="\t"),
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types={column: pyarrow.string() for column in header},
+            include_columns=[
+                column
+                for column in header
+                if columns is None or column.strip() in columns
+            ],
+            # Same as the defaults pandas reads as missing
+            null_values=[*pyarrow.csv.ConvertOptions().null_values, "<NA>"],
+            strings_can_be_null=True,
+        ),
+    )
+    df = table.to_pandas(
+        types_mapper={pyarrow.string(): pd.StringDtype("pyarrow")}.get
+    )
+    return index_by_key(df)
+
+
+def snapshot_lines(source: Path | TextIO) -> list[bytes]:
+    """
+    Reads every line of an input file, header included, as bytes
+    """
+    if isinstance(source, Path):
+        with source.open("rb") as f:
+            return f.readlines()
+    # Go around any text layer, the lines are only compared and re-read
+    lines = getattr(source, "buffer", source).readlines()
+    return [line.encode() if isinstance(line, str) else line for line in lines]
+
+
+def snapshot_digest(source: Path | TextIO) -> bytes:
+    """
+    Hashes the contents of an input file, leaving file objects where they were
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(source, Path):
+        with source.open("rb") as f:
+            while block := f.read(1024**2):
+                digest.update(block)
+    else:
+        position = source.tell()
+        contents = source.read()
+        source.seek(position)
+        if isinstance(contents, str):
+            contents = contents.encode()
+        digest.update(contents)
+    return digest.digest()
+
+
+def snapshot_header(source: Path | TextIO) -> list[str]:
+    """
+    Reads the column names from the first line of an input file,
+    leaving file objects where they were
+    """
+    if isinstance(source, Path):
+        with source.open() as f:
+            line = f.readline()
+    else:
+        position = source.tell()
+        line = source.readline()
+        source.seek(position)
+        if isinstance(line, bytes):
+            line = line.decode()
+    return line.rstrip("\r\n").split("\t")
+
+
+def index_by_key(snapshot: pd.DataFrame) -> pd.DataFrame:
+    """
+    Replaces the @id and @type columns of a snapshot with an index of
+    feature keys, which sorts in the same order Overpass outputs features
+    """
+    snapshot.index = pd.Index(
+        pack_ids(snapshot.pop("@type"), snapshot.pop("@id")), name="id"
+    )
+    return snapshot
+
+
+def pack_ids(types: Iterable[str], ids: Iterable) -> np.ndarray:
+    """
+    Packs feature types like "way" and numeric ids into integer feature keys
+    """
+    codes = pd.Index(types, dtype=object).map(TYPE_ORDER).to_numpy(np.int64)
+    return (codes << TYPE_SHIFT) | pd.Index(ids).astype(np.int64).to_numpy()
+
+
+def unpack_id(key: int) -> OsmObj[str, str]:
+    """
+    Separates a feature key into a tuple like ('node', '12345678')
+    """
+    key = int(key)
+    return OsmObj(TYPE_NAMES[key >> TYPE_SHIFT], str(key & ID_MASK))
+
+
+def prefixed_ids(prefixes: list[str], keys: Iterable[int]) -> np.ndarray:
+    """
+    Gives each feature key's numeric id as a string,
+    after the prefix for its type from a list in TYPE_ORDER
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    types = keys >> TYPE_SHIFT
+    ids = keys & ID_MASK
+    if pyarrow is None:
+        return (
+            pd.Series(np.array(prefixes, dtype=object)[types])
+            + pd.Series(ids).astype(str)
+        ).to_numpy()
+    # Arrow formats and joins the strings without a Python call per feature
+    return pyarrow.compute.binary_join_element_wise(
+        pyarrow.array(prefixes).take(types),
+        pyarrow.compute.cast(pyarrow.array(ids), pyarrow.string()),
+        "",
+    ).to_numpy(zero_copy_only=False)
+
+
+def render_ids(keys: Iterable[int]) -> pd.Index:
+    """
+    Gives the id string, like "n12345678", for each feature key
+    """
+    return pd.Index(
+        prefixed_ids([name[0] for name in TYPE_NAMES], keys), name="id"
+    )
+
+
+def josm_urls(keys: Iterable[int]) -> np.ndarray:
+    """
+    Returns a JOSM remote control url for each feature key
+    """
+    return prefixed_ids([JOSM_URL + name[0] for name in TYPE_NAMES], keys)
+
+
+def pewu_urls(keys: Iterable[int]) -> np.ndarray:
+    """
+    Returns a Pewu url for each feature key
+    """
+    return prefixed_ids([f"{PEWU_URL}{name}/" for name in TYPE_NAMES], keys)
+
+
+def osmcha_urls(changesets: pd.Series) -> pd.Series:
+    """
+    Returns an OSMCha url for each changeset id, missing where it is missing
+    """
+    return (OSMCHA_URL + changesets.astype("string")).astype(object)
+
+
+def parse_ids(feature_ids: Iterable[str]) -> np.ndarray:
+    """
+    Gives the feature key for each id string,
+    including every id in grouped ids like "w1,w2"
+    """
+    feature_ids = pd.Series(feature_ids, dtype=object)
+    if feature_ids.str.contains(",", regex=False).any():
+        feature_ids = feature_ids.str.split(",").explode()
+        feature_ids = feature_ids[feature_ids.str.len() > 0]
+    return pack_ids(
+        feature_ids.str[0].map(TYPE_EXPANSION), feature_ids.str[1:]
+    )
+
+
+def ids_by_type(keys: Iterable[int]) -> dict[str, np.ndarray]:
+    """
+    Separates feature keys into the numeric ids of each feature type,
+    leaving out types that have none
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    types = keys >> TYPE_SHIFT
+    return {
+        name: keys[types == code] & ID_MASK
+        for code, name in enumerate(TYPE_NAMES)
+        if (types == code).any()
+    }
+
+
+def split_ids(feature_ids: Iterable[str]) -> pd.DataFrame:
+    """
+    Separates ids like "n12345678" into obj_type and obj_id columns,
+    like split_id does for a single id
+    """
+    parts = pd.Series(feature_ids, dtype=object).str.extract(FEATURE_ID_REGEX)
+    return pd.DataFrame(
+        {"obj_type": parts[0].map(TYPE_EXPANSION), "obj_id": parts[1]}
+    )
+
+
+def feature_type_and_number(feature_id: str | int) -> OsmObj[str, str]:
+    """
+    The type and id number of a feature id string or feature key
+    """
+    if isinstance(feature_id, str):
+        return split_id(feature_id)
+    return unpack_id(feature_id)
 
 
 def split_id(feature_id: str | int) -> OsmObj[str, str]:
     """
     Separates an id like "n12345678" into the tuple ('node', '12345678')
     """
-    feature_id = str(feature_id)
-    typeregex = re.compile(r"\A[nwr]")
-    idregex = re.compile(r"\d+\Z")
-
-    typematch = typeregex.search(feature_id)
-    ftype = TYPE_EXPANSION.get(typematch.group()) if typematch else None
-    idmatch = idregex.search(feature_id).group()
-    return OsmObj(ftype, idmatch)
+    match = FEATURE_ID_REGEX.search(str(feature_id))
+    return OsmObj(TYPE_EXPANSION.get(match[1]), match[2])
 
 
 def separate_ids_by_feature_type(mixed: list[str]) -> dict[str, list[str]]:
@@ -822,13 +3055,11 @@ def separate_ids_by_feature_type(mixed: list[str]) -> dict[str, list[str]]:
     Dict[str, List[str]]: a dict with keys 'nodes', 'ways', and 'relations'
     and lists of ids as values
     """
-    f_type_id: list[tuple[str, str]] = [split_id(i) for i in mixed]
-
-    the_dict = {}
-    for k, v in f_type_id:
-        the_dict.setdefault(k, []).append(v)
-
-    return the_dict
+    grouped = split_ids(mixed).groupby("obj_type", sort=False, dropna=False)
+    return {
+        ftype if pd.notna(ftype) else None: list(ids)
+        for ftype, ids in grouped["obj_id"]
+    }
 
 
 def clean_for_presentation(user_input: str) -> str:
@@ -845,7 +3076,7 @@ def pewu_from_id(id: str) -> str:
     Returns a Pewu url from a feature ID
     """
     ftype, fid = split_id(id)
-    return f"https://pewu.github.io/osm-history/#/{ftype}/{fid}"
+    return f"{PEWU_URL}{ftype}/{fid}"
 
 
 def strip_column_suffix(input_column_name: str) -> str:
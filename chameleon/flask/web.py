@@ -11,10 +11,8 @@ from uuid import UUID, uuid4
 from zipfile import ZipFile
 
 import appdirs
-import geojson
 import gevent
 import overpass
-import pandas as pd
 import yaml
 from celery import Celery
 from celery.contrib.abortable import AbortableAsyncResult, AbortableTask
@@ -36,7 +34,6 @@ from chameleon.core import (
     HIGH_DELETIONS_THRESHOLD,
     OVERPASS_TIMEOUT,
     TYPE_EXPANSION,
-    ChameleonDataFrame,
     ChameleonDataFrameSet,
 )
 
@@ -203,8 +200,6 @@ def process_data(
     """
     if filter_list is None:
         filter_list = []
-    REQUEST_INTERVAL = 0.5
-
     error_list = []
 
     user_dir = USER_FILES_BASE / client_uuid
@@ -243,7 +238,7 @@ def process_data(
         # Client-side validation slipped up
         raise UnprocessableEntity
     with oldfile as old, newfile as new:
-        cdfs = ChameleonDataFrameSet(old, new)
+        cdfs = ChameleonDataFrameSet(old, new, modes=modes)
 
     if (
         not easy_mode
@@ -253,38 +248,45 @@ def process_data(
     ):
         raise HighDeletionPercentageError(round(deletion_percentage, 2))
 
-    df = cdfs.source_data
-
-    deleted_ids = list(df.loc[df["action"] == "deleted"].index)
+    # Features Overpass still has were only dropped, only the rest are
+    # checked on the OSM API
+    deleted_ids = cdfs.check_deletions_on_overpass()
     task_metadata["osm_api_max"] = len(deleted_ids)
     task_metadata["current_phase"] = "osm_api"
     error_count = 0
-    for num, feature_id in enumerate(deleted_ids):
-        task_metadata["osm_api_completed"] = num
-        yield {
-            "state": "PROGRESS",
-            "meta": task_metadata,
-        }
-        try:
-            element_attribs = cdfs.check_feature_on_api(
-                feature_id, app_version=APP_VERSION
-            )
-        except (Timeout, ConnectionError):
-            if error_count > 10:
-                # Too many timeouts, abandon online checker
-                task_metadata["osm_api_completed"] = task_metadata["osm_api_max"]
-                yield {
-                    "state": "PROGRESS",
-                    "meta": task_metadata,
-                }
-                break
-            error_count += 1
-        except HTTPError as e:
-            if str(e.response.status_code) == "429":
-                raise
-        else:
-            df.update(pd.DataFrame(element_attribs, index=[feature_id]))
-        gevent.sleep(REQUEST_INTERVAL)
+    # Results are written to source_data together once checking stops
+    updates = {}
+    # Closing the checker cancels the requests that haven't started
+    with contextlib.closing(
+        cdfs.check_features_on_api(deleted_ids, app_version=APP_VERSION)
+    ) as checks:
+        for num, (feature_id, element_attribs, _, error) in enumerate(checks):
+            task_metadata["osm_api_completed"] = num
+            yield {
+                "state": "PROGRESS",
+                "meta": task_metadata,
+            }
+            if isinstance(error, (Timeout, ConnectionError)):
+                if error_count > 10:
+                    # Too many timeouts, abandon online checker
+                    task_metadata["osm_api_completed"] = task_metadata[
+                        "osm_api_max"
+                    ]
+                    yield {
+                        "state": "PROGRESS",
+                        "meta": task_metadata,
+                    }
+                    break
+                error_count += 1
+            elif isinstance(error, HTTPError):
+                if str(error.response.status_code) == "429":
+                    raise error
+            elif error:
+                raise error
+            else:
+                updates[feature_id] = element_attribs
+    cdfs.update_features(updates)
+    cdfs.detect_splits_and_merges()
 
     task_metadata["osm_api_completed"] = task_metadata["osm_api_max"]
     task_metadata["current_phase"] = "modes"
@@ -293,9 +295,7 @@ def process_data(
         "meta": task_metadata,
     }
 
-    cdfs.separate_special_dfs()
-
-    for num, mode in enumerate(modes):
+    for num, mode in enumerate(cdfs.query_modes(modes, grouping=grouping)):
         # self.update_state(state="MODES", meta={"mode": mode})
         task_metadata["modes_completed"] = num
         task_metadata["current_mode"] = mode
@@ -303,15 +303,7 @@ def process_data(
             "state": "PROGRESS",
             "meta": task_metadata,
         }
-
-        try:
-            result = ChameleonDataFrame(
-                cdfs.source_data, mode=mode, grouping=grouping
-            ).query_cdf()
-        except KeyError:
-            error_list.append(mode)
-            continue
-        cdfs.add(result)
+    error_list += [mode for mode in modes if mode not in cdfs.modes]
 
     if file_format == "geojson":
         for response in write_geojson(cdfs, user_dir, output):
@@ -444,7 +436,7 @@ def return_osm_tag() -> Response:
 def high_deletions_checker(cdfs: ChameleonDataFrameSet) -> float:
     return (
         len(cdfs.source_data[cdfs.source_data["action"] == "deleted"])
-        / max(len(cdfs.source_data), 1)  # Protect against zero division
+        / max(cdfs.feature_count, 1)  # Protect against zero division
     ) * 100
 
 
@@ -466,7 +458,7 @@ def write_csv(dataframe_set, base_dir, output) -> str:
             file_name = f"{output}_{result.chameleon_mode_cleaned}.csv"
             temp_path = Path(tempdir) / file_name
             with temp_path.open("w") as output_file:
-                result.to_csv(output_file, sep="\t", index=True)
+                result.formatted().to_csv(output_file, sep="\t", index=True)
             myzip.write(temp_path, arcname=file_name)
 
     return zip_name
@@ -484,9 +476,11 @@ def write_excel(dataframe_set, base_dir, output) -> str:
 def write_geojson(
     dataframe_set, base_dir, output
 ) -> Generator[dict[str, str | int], None, dict[str, str]]:
+    file_name = f"{output}.geojson"
+    file_path = Path(safe_join(base_dir, file_name)).resolve()
     overpass_query = dataframe_set.OverpassQuery(dataframe_set, OVERPASS_TIMEOUT)
 
-    for _ in overpass_query.get():
+    for _ in overpass_query.write_geojson(file_path):
         yield {
             "overpass_start_time": overpass_query.overpass_start_time.isoformat(),
             "overpass_timeout_time": overpass_query.overpass_timeout_time.isoformat(),
@@ -507,12 +501,6 @@ def write_geojson(
     #         "to accept any more queries for a period of time",
     #     )
 
-    file_name = f"{output}.geojson"
-    file_path = Path(safe_join(base_dir, file_name)).resolve()
-
-    with file_path.open("w") as output_file:
-        geojson.dump(overpass_query.geojson, output_file)
-
     return {"file_name": file_name}
 
 
@@ -12,16 +12,14 @@ import string
 import sys
 import time
 from collections import Counter
-from contextlib import suppress
+from contextlib import closing, suppress
 from copy import deepcopy
 from datetime import datetime
 from io import BytesIO
 from pathlib import Path
 from typing import Iterable, Mapping
 
-import geojson
 import overpass
-import pandas as pd
 import yaml
 
 # Finds the right place to save config and log files on each OS
@@ -247,6 +245,7 @@ class Worker(QObject):
                 use_api=self.use_api,
                 extra_columns=self.load_extra_columns(),
                 config=self.config,
+                modes=self.modes,
             )
 
             if self.high_deletions_checker(cdf_set):
@@ -262,25 +261,16 @@ class Worker(QObject):
                     # Rate-limited by server
                     return
 
-            # Separate out the new and deleted dataframes
-            cdf_set.separate_special_dfs()
-
-            for mode in self.modes:
+            # Separates out the new and deleted dataframes, then each mode
+            for mode in cdf_set.query_modes(
+                self.modes, grouping=self.group_output
+            ):
                 logger.debug("Executing processing for %s.", mode)
                 self.mode_start.emit(mode)
-                try:
-                    result = ChameleonDataFrame(
-                        cdf_set.source_data,
-                        mode=mode,
-                        grouping=self.group_output,
-                        config=self.config,
-                    ).query_cdf()
-                except KeyError as e:
-                    # File reading failed, usually because a nonexistent column
-                    logger.exception(e)
-                    self.error_list.append(mode)
-                    continue
-                cdf_set.add(result)
+            # Querying fails usually because of a nonexistent column
+            self.error_list += [
+                mode for mode in self.modes if mode not in cdf_set.modes
+            ]
             self.write_output[self.format](cdf_set)
         except Exception as e:
             self.dialog.emit(
@@ -380,7 +370,7 @@ class Worker(QObject):
         """
         deletion_percentage = (
             len(cdf_set.source_data[cdf_set.source_data["action"] == "deleted"])
-            / len(cdf_set.source_data)
+            / cdf_set.feature_count
         ) * 100
 
         # The order matters here. user_confirm() waits for user input,
@@ -412,51 +402,52 @@ class Worker(QObject):
         """
         Pings OSM server to see if ways were actually deleted or just dropped
         """
-        # How long to wait between API calls
-        REQUEST_INTERVAL = 0.1
-
-        df = cdfs.source_data
-
         empty_count = 0
-        deleted_ids = list(df.loc[df["action"] == "deleted"].index)
+        # Features Overpass still has were only dropped, only the rest are
+        # checked on the OSM API
+        deleted_ids = cdfs.check_deletions_on_overpass()
         self.scale_with_api_items.emit(len(deleted_ids))
-        for feature_id in deleted_ids:
-            from_cache = False
-            # Ends the API check early if the user cancels it
-            if self.thread().isInterruptionRequested():
-                raise UserCancelledError
-            self.increment_progbar_api.emit()
-
-            try:
-                element_attribs, from_cache = cdfs.check_feature_on_api(
-                    feature_id, app_version=APP_VERSION
-                )
-            except (Timeout, ConnectionError) as e:
-                # Couldn't contact the server, could be client-side
-                logger.exception(e)
-                if empty_count > 20:
-                    break
-                empty_count += 1
-                continue
-            except HTTPError as e:
-                if str(e.response.status_code) == "429":
-                    retry_after = e.response.headers.get("retry-after", "")
+        # Results are written to source_data together once checking stops
+        updates = {}
+        # Closing the checker cancels the requests that haven't started
+        with closing(
+            cdfs.check_features_on_api(deleted_ids, app_version=APP_VERSION)
+        ) as checks:
+            for feature_id, element_attribs, _, error in checks:
+                # Ends the API check early if the user cancels it
+                if self.thread().isInterruptionRequested():
+                    raise UserCancelledError
+                self.increment_progbar_api.emit()
+
+                if isinstance(error, (Timeout, ConnectionError)):
+                    # Couldn't contact the server, could be client-side
+                    logger.exception(error)
+                    if empty_count > 20:
+                        break
+                    empty_count += 1
+                    continue
+                if isinstance(error, HTTPError):
+                    if str(error.response.status_code) == "429":
+                        retry_after = error.response.headers.get(
+                            "retry-after", ""
+                        )
+                        logger.error(
+                            "The OSM server says you've made "
+                            "too many requests. "
+                            "You can retry after %s seconds.",
+                            retry_after,
+                        )
+                        raise error
                     logger.error(
-                        "The OSM server says you've made too many requests."
-                        "You can retry after %s seconds.",
-                        retry_after,
+                        "Server replied with a %s error",
+                        error.response.status_code,
                     )
-                    raise
-                logger.error(
-                    "Server replied with a %s error", e.response.status_code
-                )
-                element_attribs = {}
+                elif error:
+                    raise error
 
-            df.update(pd.DataFrame(element_attribs, index=[feature_id]))
-
-            if not from_cache:
-                # Wait between iterations to avoid ratelimit problems
-                time.sleep(REQUEST_INTERVAL)
+                updates[feature_id] = element_attribs
+        cdfs.update_features(updates)
+        cdfs.detect_splits_and_merges()
         self.check_api_done.emit()
 
     def write_csv(self, dataframe_set: ChameleonDataFrameSet) -> None:
@@ -465,7 +456,7 @@ class Worker(QObject):
         """
 
         def to_csv(output_file: BytesIO, mode: str) -> None:
-            result.to_csv(
+            result.formatted().to_csv(
                 output_file, mode=mode, sep="\t", index=True, encoding="utf-8"
             )
 
@@ -520,11 +511,17 @@ class Worker(QObject):
         Writes all members of a ChameleonDataFrameSet to a geojson file,
         using the overpass API
         """
+        file_name = self.files["output"].with_suffix(".geojson")
+        self.output_path = self.files["output"].parent
+        # Asked before fetching anything, rather than once it's all fetched
+        if file_name.is_file() and not self.overwrite_confirm(file_name):
+            logger.info("User chose not to overwrite")
+            return
         overpass_query = dataframe_set.OverpassQuery(dataframe_set)
 
-        logger.info("Querying Overpass…")
+        logger.info("Querying Overpass and writing geojson…")
         try:
-            for _ in overpass_query.get():
+            for _ in overpass_query.write_geojson(file_name):
                 self.overpass_counter.emit(
                     overpass_query.overpass_start_time,
                     overpass_query.overpass_timeout_time,
@@ -559,52 +556,25 @@ class Worker(QObject):
                 "critical",
             )
             return
-        finally:
-            self.overpass_complete.emit()
-        logger.info("All responses recieved from Overpass.")
-
-        logger.info("Writing geojson…")
-        file_name = self.files["output"].with_suffix(".geojson")
-
-        try:
-            with file_name.open("x") as output_file:
-                geojson.dump(overpass_query.geojson, output_file, indent=4)
-        except FileExistsError:
-            if not self.overwrite_confirm(file_name):
-                logger.info("User chose not to overwrite")
-            else:
-                fc = (
-                    overpass_query.geojson
-                )  # Assign this before opening the file
-                with file_name.open("w") as output_file:
-                    geojson.dump(fc, output_file, indent=4)
-                self.successful_items.update(
-                    {
-                        result.chameleon_mode: success_message(result)
-                        for result in dataframe_set.nondeleted
-                    }
-                )
-                logger.info(
-                    "Processing complete. %s written.",
-                    file_name,
-                )
         except OSError:
             logger.exception("Write error.")
             self.error_list += [
                 result.chameleon_mode for result in dataframe_set.nondeleted
             ]
-        else:
-            self.successful_items.update(
-                {
-                    result.chameleon_mode: success_message(result)
-                    for result in dataframe_set.nondeleted
-                }
-            )
-            logger.info(
-                "Processing complete. %s written.",
-                file_name,
-            )
-        self.output_path = self.files["output"].parent
+            return
+        finally:
+            self.overpass_complete.emit()
+
+        self.successful_items.update(
+            {
+                result.chameleon_mode: success_message(result)
+                for result in dataframe_set.nondeleted
+            }
+        )
+        logger.info(
+            "Processing complete. %s written.",
+            file_name,
+        )
 
     def write_report(self) -> None:
         report_path: Path = self.files["report"]
@@ -10,6 +10,15 @@ import pytest
 from chameleon.core import ChameleonDataFrame, ChameleonDataFrameSet
 
 
+@pytest.fixture(autouse=True)
+def cache_location(tmp_path, monkeypatch):
+    """
+    Keeps each test's cached merges out of the user's cache
+    """
+    monkeypatch.setattr("chameleon.core.CACHE_LOCATION", tmp_path / "cache")
+    return tmp_path / "cache"
+
+
 @pytest.fixture
 def files():
     return {"old": Path("test/old.csv"), "new": Path("test/new.csv")}
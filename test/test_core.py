@@ -2,16 +2,44 @@
 Unit tests for core.py file.
 """
 import json
+import re
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from urllib.parse import unquote_plus
 
+import numpy as np
+import overpass
+import pandas as pd
 import pytest
+import yaml
 from pandas.testing import assert_frame_equal
 
+import chameleon.core
 from chameleon.core import (
     ChameleonDataFrame,
     ChameleonDataFrameSet,
+    ElementStore,
+    GeometryStore,
+    OsmObj,
+    adapted_page_length,
+    compile_filters,
+    free_slots,
+    ids_by_type,
+    match_successors,
+    max_groups,
+    pack_ids,
+    parse_ids,
+    parse_slot_status,
+    pewu_from_id,
+    pewu_urls,
+    render_ids,
     separate_ids_by_feature_type,
     split_id,
+    split_ids,
+    unpack_id,
 )
 
 
@@ -133,3 +161,880 @@ def test_separate_ids_by_feature_type(mixed, gold):
 )
 def test_split_id(fid, gold):
     assert gold == split_id(fid)
+
+
+@pytest.mark.parametrize(
+    "feature_ids",
+    [["n1234567", "n23456789", "w5678901", "w7801234", "r123456"]],
+)
+def test_feature_keys(feature_ids):
+    keys = pack_ids(*zip(*(split_id(fid) for fid in feature_ids)))
+    # Keys sort by type, then numerically by id
+    assert list(keys) == sorted(keys)
+    assert list(render_ids(keys)) == feature_ids
+    assert list(parse_ids([",".join(feature_ids)])) == list(keys)
+    assert [unpack_id(key) for key in keys] == [
+        split_id(fid) for fid in feature_ids
+    ]
+    assert list(pewu_urls(keys)) == [pewu_from_id(fid) for fid in feature_ids]
+    assert {ftype: list(ids) for ftype, ids in ids_by_type(keys).items()} == {
+        ftype: [int(fid) for fid in ids]
+        for ftype, ids in separate_ids_by_feature_type(feature_ids).items()
+    }
+
+
+def test_split_ids():
+    feature_ids = ["n1234567", "w1234567", "r01234567", "way1234567"]
+    assert list(split_ids(feature_ids).itertuples(index=False)) == [
+        split_id(fid) for fid in feature_ids
+    ]
+
+
+def test_tag_pairs_share_categories(files):
+    cdf_set = ChameleonDataFrameSet(**files)
+    source_data = cdf_set.source_data
+    assert source_data["highway_old"].dtype == source_data["highway_new"].dtype
+    assert source_data["user_old"].dtype == source_data["user_new"].dtype
+
+    feature_id = source_data.index[0]
+    cdf_set.update_feature(
+        feature_id, {"user_new": "a new user", "action": "dropped"}
+    )
+    assert source_data.loc[feature_id, "user_new"] == "a new user"
+    assert source_data.loc[feature_id, "action"] == "dropped"
+    assert source_data["user_old"].dtype == source_data["user_new"].dtype
+
+
+def test_update_features(files):
+    one_by_one = ChameleonDataFrameSet(**files)
+    together = ChameleonDataFrameSet(**files)
+    feature_ids = one_by_one.source_data.index[:3]
+    updates = {
+        feature_ids[0]: {"user_new": "a new user", "version_new": "99"},
+        feature_ids[1]: {},
+        feature_ids[2]: {
+            "user_new": "another user",
+            "timestamp_new": "2021-01-01T00:00:00Z",
+            "action": "dropped",
+        },
+    }
+    for feature_id, element_attribs in updates.items():
+        one_by_one.update_feature(feature_id, element_attribs)
+    together.update_features(updates)
+    assert_frame_equal(together.source_data, one_by_one.source_data)
+    assert together.source_data.at[feature_ids[0], "version"] == 99
+    assert together.source_data.at[feature_ids[2], "user"] == "another user"
+
+
+@pytest.mark.parametrize("chunksize", [500, 100000])
+def test_streaming_merge(chunksize, files):
+    in_memory = ChameleonDataFrameSet(
+        **files, csv_engine="c", prune_unchanged=False
+    ).source_data
+    streamed = ChameleonDataFrameSet(
+        **files, chunksize=chunksize, prune_unchanged=False
+    ).source_data
+    assert_frame_equal(
+        in_memory.sort_index(), streamed.sort_index()[in_memory.columns]
+    )
+    # Unchanged features are dropped from each chunk, as pruning would
+    in_memory = ChameleonDataFrameSet(**files, csv_engine="c")
+    streamed = ChameleonDataFrameSet(**files, chunksize=chunksize)
+    assert streamed.feature_count == in_memory.feature_count
+    assert_frame_equal(
+        in_memory.source_data.sort_index(),
+        streamed.source_data.sort_index()[in_memory.source_data.columns],
+    )
+    # With modes, only features that changed in them are kept
+    in_memory = ChameleonDataFrameSet(**files, modes=["ref"])
+    streamed = ChameleonDataFrameSet(
+        **files, modes=["ref"], chunksize=chunksize
+    )
+    assert len(streamed.source_data) < len(in_memory.source_data)
+    assert streamed.feature_count == in_memory.feature_count
+    for cdf_set in (in_memory, streamed):
+        list(cdf_set.query_modes(["ref"]))
+    for mode in ("ref", "new", "deleted"):
+        assert_frame_equal(in_memory[mode], streamed[mode])
+
+
+def test_streaming_merge_unsorted(files, tmp_path):
+    header, *rows = files["new"].read_text().splitlines(keepends=True)
+    unsorted = tmp_path / "unsorted.csv"
+    unsorted.write_text(header + "".join(reversed(rows)))
+    with pytest.raises(ValueError):
+        ChameleonDataFrameSet(files["old"], unsorted, chunksize=500)
+
+
+@pytest.mark.parametrize("mode", ["highway", "ref", "name"])
+def test_prune_unchanged(mode, files):
+    full = ChameleonDataFrameSet(**files, prune_unchanged=False)
+    pruned = ChameleonDataFrameSet(**files)
+    assert len(pruned.source_data) < len(full.source_data)
+    assert pruned.feature_count == full.feature_count
+    assert_frame_equal(
+        ChameleonDataFrame(full.source_data, mode).query_cdf(),
+        ChameleonDataFrame(pruned.source_data, mode).query_cdf(),
+    )
+
+
+@pytest.mark.parametrize("mode", ["highway", "ref"])
+def test_merge_cache(mode, files, cache_location):
+    feather = pytest.importorskip("pyarrow.feather")
+    uncached = ChameleonDataFrameSet(**files, cache_merges=False)
+    first = ChameleonDataFrameSet(**files)
+    assert len(list((cache_location / "merged").glob("*.feather"))) == 1
+    # The entry with every column serves any modes
+    second = ChameleonDataFrameSet(**files, modes=[mode])
+    assert len(list((cache_location / "merged").glob("*.feather"))) == 1
+    assert second.feature_count == uncached.feature_count
+    assert {"int_ref_old", "int_ref_new"}.isdisjoint(
+        second.source_data.columns
+    )
+    # A miss only reads and caches the columns of the modes
+    third = ChameleonDataFrameSet(**files, modes=[mode], prune_unchanged=False)
+    fourth = ChameleonDataFrameSet(
+        **files, modes=[mode], prune_unchanged=False
+    )
+    entries = list((cache_location / "merged").glob("*.feather"))
+    assert len(entries) == 2
+    assert_frame_equal(third.source_data, fourth.source_data)
+    columns = [feather.read_table(entry).column_names for entry in entries]
+    assert sorted("int_ref_old" in names for names in columns) == [False, True]
+    for cdf_set in (first, second, third, fourth):
+        assert_frame_equal(
+            ChameleonDataFrame(uncached.source_data, mode).query_cdf(),
+            ChameleonDataFrame(cdf_set.source_data, mode).query_cdf(),
+        )
+
+
+def test_merge_cache_eviction(files, cache_location, monkeypatch):
+    pytest.importorskip("pyarrow")
+    monkeypatch.setattr("chameleon.core.MERGE_CACHE_SIZE", 1)
+    ChameleonDataFrameSet(**files)
+    ChameleonDataFrameSet(**files, prune_unchanged=False)
+    # Only the latest entry is kept, even though it's over the limit
+    assert len(list((cache_location / "merged").glob("*.feather"))) == 1
+
+
+def test_query_modes(files):
+    modes = ["highway", "ref", "name", "int_ref", "missing"]
+    cdf_set = ChameleonDataFrameSet(**files)
+    source_data = cdf_set.source_data.copy()
+    assert list(cdf_set.query_modes(modes)) == modes
+    assert cdf_set.modes == {"new", "deleted", *modes} - {"missing"}
+    # Each mode only gets the features that were modified
+    source_data = source_data[source_data["action"] == "modified"]
+    for mode in modes[:-1]:
+        assert_frame_equal(
+            cdf_set[mode], ChameleonDataFrame(source_data, mode).query_cdf()
+        )
+
+
+@pytest.mark.parametrize("mode", ["highway", "ref"])
+def test_selected_modes_columns(mode, files):
+    full = ChameleonDataFrameSet(**files)
+    narrow = ChameleonDataFrameSet(**files, modes=[mode])
+    assert {"int_ref_old", "int_ref_new"}.isdisjoint(
+        narrow.source_data.columns
+    )
+    assert_frame_equal(
+        ChameleonDataFrame(full.source_data, mode).query_cdf(),
+        ChameleonDataFrame(narrow.source_data, mode).query_cdf(),
+    )
+
+
+@pytest.mark.parametrize("mode", ["highway", "ref", "name"])
+def test_arrow_engine(mode, files):
+    pytest.importorskip("pyarrow")
+    results = [
+        ChameleonDataFrame(
+            ChameleonDataFrameSet(**files, csv_engine=engine).source_data,
+            mode,
+        ).query_cdf()
+        for engine in ("c", "pyarrow")
+    ]
+    assert_frame_equal(*results, check_dtype=False)
+
+
+def test_metadata_columns(files):
+    cdf_set = ChameleonDataFrameSet(**files)
+    source_data = cdf_set.source_data
+    assert isinstance(source_data["timestamp"].dtype, pd.DatetimeTZDtype)
+    assert source_data["version"].dtype == "Int64"
+    list(cdf_set.query_modes(["highway"]))
+    result = cdf_set["highway"].formatted()
+    assert result["timestamp"].str.fullmatch(r"\d{4}-\d{2}-\d{2}|").all()
+    assert result["version"].map(type).eq(str).all()
+
+
+def test_grouped_output():
+    with open("test/test_grouped_q_output.yaml") as f:
+        gold = pd.DataFrame(
+            yaml.unsafe_load(f),
+            columns=[
+                "url",
+                "count",
+                "users",
+                "latest_timestamp",
+                "version",
+                "highway",
+                "old_name",
+                "new_name",
+                "action",
+                "notes",
+            ],
+        )
+    # The fixture predates new and deleted features being separated out, and
+    # took the last version and highway of each group instead of aggregating
+    columns = ["url", "count", "users", "latest_timestamp", "old_name"]
+    columns += ["new_name", "action"]
+    gold = gold.loc[gold["action"] == "modified", columns]
+    cdf_set = ChameleonDataFrameSet("test/old.csv", "test/new.csv")
+    cdf_set.separate_special_dfs()
+    result = ChameleonDataFrame(cdf_set.source_data, "name", grouping=True)
+    result = result.query_cdf().formatted()[columns]
+    assert_frame_equal(
+        result.sort_values("url").reset_index(drop=True),
+        gold.sort_values("url").reset_index(drop=True),
+    )
+
+
+def test_filter_rules(files):
+    config = {
+        "filter_rules": [
+            {"modes": ["ref"], "require_any": ["name"]},
+            {"exclude_users": ["Evandering"]},
+        ]
+    }
+    cdf_set = ChameleonDataFrameSet(**files)
+    cdf_set.separate_special_dfs()
+    unfiltered = ChameleonDataFrame(cdf_set.source_data, "ref").query_cdf()
+    filtered = ChameleonDataFrame(cdf_set.source_data, "ref", config=config)
+    filtered = filtered.query_cdf()
+    assert 0 < len(filtered) < len(unfiltered)
+    assert_frame_equal(
+        filtered,
+        unfiltered[
+            (unfiltered["name"] != "") & (unfiltered["user"] != "Evandering")
+        ],
+    )
+
+    with pytest.raises(ValueError):
+        compile_filters({"filter_rules": [{"require_all": ["name"]}]})
+
+
+def test_filter_rule_columns(files):
+    rule = {"modes": ["ref"], "require_any": ["int_ref", "name"]}
+    cdf_set = ChameleonDataFrameSet(
+        **files, config={"filter_rules": [rule]}, modes=["ref"]
+    )
+    # Read for the rule even though no mode uses it
+    assert "int_ref" in cdf_set.needed_columns
+    list(cdf_set.query_modes(["ref"]))
+    result = cdf_set["ref"]
+    assert 0 < len(result)
+    assert ((result["int_ref"] != "") | (result["name"] != "")).all()
+
+
+def test_highway_change_score(cdf_set):
+    cdf_set.separate_special_dfs()
+    changes = ChameleonDataFrame(
+        cdf_set.source_data, "highway", config={"highway_step_change": 2}
+    ).select_changes()
+    columns = list(changes.columns)
+    result = changes.finalize()
+    # The rules leave the changes they are given alone
+    assert list(changes.columns) == columns
+    assert result["highway_change_score"].dtype == "Int64"
+    assert (result["highway_change_score"] >= 2).all()
+    assert "\t2\n" in result.formatted().to_csv(sep="\t")
+
+
+@pytest.fixture
+def osm_api(monkeypatch):
+    """
+    Serves way histories, and the latest versions of many ways, from the test
+    fixtures on a local port. Way 796424739 is deleted, every other way has
+    the history of 389652224, which wasn't. The first request that includes
+    way 796424739 is rate limited
+    """
+    histories = {
+        fid: json.loads(Path(f"test/way{fid}.json").read_text())
+        for fid in ("389652224", "796424739")
+    }
+
+    def history(fid: str) -> list[dict]:
+        elements = histories.get(fid, histories["389652224"])["elements"]
+        return [{**element, "id": int(fid)} for element in elements]
+
+    server_state = {
+        "active": 0,
+        "most_active": 0,
+        "requests": [],
+        "retry_after": "1",
+    }
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path, _, query = self.path.partition("?")
+            if query:
+                fids = query.partition("=")[2].split(",")
+                elements = [history(fid)[-1] for fid in fids]
+            else:
+                fids = [path.split("/")[-2]]
+                elements = history(fids[0])
+            with lock:
+                server_state["active"] += 1
+                server_state["most_active"] = max(
+                    server_state["most_active"], server_state["active"]
+                )
+                rate_limited = "796424739" in fids and not any(
+                    "796424739" in request
+                    for request in server_state["requests"]
+                )
+                server_state["requests"].append(fids)
+            time.sleep(0.05)
+            if rate_limited:
+                self.send_response(429)
+                self.send_header("Retry-After", server_state["retry_after"])
+                body = b""
+            else:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                body = json.dumps({"elements": elements}).encode()
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            with lock:
+                server_state["active"] -= 1
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(
+        chameleon.core,
+        "OSM_API_URL",
+        f"http://127.0.0.1:{server.server_port}/api/0.6/",
+    )
+    yield server_state
+    server.shutdown()
+
+
+def test_check_features_on_api(files, osm_api, monkeypatch):
+    monkeypatch.setattr(chameleon.core, "API_BATCH_SIZE", 4)
+    cdf_set = ChameleonDataFrameSet(**files, api_rate=1000)
+    feature_ids = ["w389652224", "w796424739"]
+    feature_ids += [f"w{fid}" for fid in range(1, 19)]
+    with open("test/way796424739.json") as f:
+        last_nodes = json.load(f)["elements"][-2]["nodes"]
+    start = time.monotonic()
+    checks = {
+        check.feature_id: check
+        for check in cdf_set.check_features_on_api(
+            feature_ids, max_in_flight=3
+        )
+    }
+    assert set(checks) == set(feature_ids)
+    assert [check.error for check in checks.values() if check.error] == []
+    assert checks["w796424739"].element_attribs == {
+        "user_new": "wobness",
+        "timestamp_new": "2020-05-07T15:40:29Z",
+        "version_new": "2",
+        "changeset_new": "84841207",
+    }
+    assert checks["w389652224"].element_attribs["action"] == "dropped"
+    # Only the deleted way needed its history, for its last members
+    assert cdf_set.deleted_way_members == {"w796424739": last_nodes}
+    assert sorted(map(len, osm_api["requests"])) == [1, 4, 4, 4, 4, 4, 4]
+    # The rate limited request was retried once the server allowed it
+    assert time.monotonic() - start >= 1
+    assert 1 < osm_api["most_active"] <= 3
+
+    # A second run is answered from the element store
+    osm_api["requests"].clear()
+    cdf_set = ChameleonDataFrameSet(**files, api_rate=1000)
+    rechecks = {
+        check.feature_id: check
+        for check in cdf_set.check_features_on_api(feature_ids)
+    }
+    assert osm_api["requests"] == []
+    assert all(check.from_cache for check in rechecks.values())
+    assert {
+        feature_id: check.element_attribs
+        for feature_id, check in rechecks.items()
+    } == {
+        feature_id: check.element_attribs
+        for feature_id, check in checks.items()
+    }
+    assert cdf_set.deleted_way_members == {"w796424739": last_nodes}
+
+
+def test_check_features_on_api_closed(files, osm_api):
+    cdf_set = ChameleonDataFrameSet(**files, api_rate=1000)
+    threads = set(threading.enumerate())
+    checks = cdf_set.check_features_on_api(
+        [f"w{fid}" for fid in range(1, 41)], max_in_flight=4
+    )
+    next(checks)
+    checks.close()
+    # The checks that were running finished before close returned
+    assert set(threading.enumerate()) <= threads
+    assert len(osm_api["requests"]) < 10
+
+
+def test_check_features_on_api_long_retry_after(files, osm_api, monkeypatch):
+    monkeypatch.setattr(chameleon.core, "API_BATCH_SIZE", 4)
+    osm_api["retry_after"] = "3600"
+    cdf_set = ChameleonDataFrameSet(**files, api_rate=1000)
+    feature_ids = ["w796424739", *(f"w{fid}" for fid in range(1, 8))]
+    start = time.monotonic()
+    errors = {
+        check.feature_id: check.error
+        for check in cdf_set.check_features_on_api(feature_ids)
+    }
+    # Only the rate limited batch fails, without waiting
+    assert time.monotonic() - start < 1
+    failed = [feature_id for feature_id, error in errors.items() if error]
+    assert sorted(failed) == sorted(feature_ids[:4])
+    assert "3600 seconds" in str(errors["w796424739"])
+
+
+def test_check_deletions_on_overpass(cdf_set):
+    class Overpass:
+        """
+        Still has the first three features of each page,
+        and fails to answer the last page
+        """
+
+        def __init__(self):
+            self.queries = []
+
+        def get(self, query, verbosity, responseformat):
+            self.queries.append(query)
+            if len(self.queries) == 3:
+                raise overpass.ServerLoadError(0)
+            ids = query.partition("(id:")[2].partition(")")[0].split(",")
+            return {
+                "elements": [
+                    {
+                        "type": "way",
+                        "id": int(fid),
+                        "version": 7,
+                        "user": "Evandering",
+                        "changeset": 42,
+                        "timestamp": "2020-05-07T15:40:29Z",
+                    }
+                    for fid in ids[:3]
+                ]
+            }
+
+    df = cdf_set.source_data
+    deleted = df.index[df["action"] == "deleted"]
+    cdf_set.page_length = -(-len(deleted) // 3)
+    api = Overpass()
+    remaining = cdf_set.check_deletions_on_overpass(api)
+    assert len(api.queries) == 3
+    assert len(remaining) == len(deleted) - 6
+    df = cdf_set.source_data
+    dropped = df.loc[deleted.difference(remaining)]
+    assert dropped["action"].eq("dropped").all()
+    assert dropped["user_new"].eq("Evandering").all()
+    assert df.loc[remaining, "action"].eq("deleted").all()
+
+
+def test_match_successors():
+    ways = dict(zip(range(15), pack_ids(["way"] * 15, range(15))))
+    deleted_members = {
+        ways[1]: [1, 2, 3, 4, 5],
+        ways[2]: [20, 21, 22],
+        ways[3]: [30, 31],
+        ways[4]: [40, 41, 42, 43],
+    }
+    way_nodes = {
+        ways[10]: [1, 2, 3],
+        # Runs the other way
+        ways[11]: [5, 4, 3],
+        # Only meets way 1, and shares no segment with way 3
+        ways[12]: [5, 30, 99],
+        ways[13]: [19, 20, 21, 22, 23],
+        # Meets way 4 at both ends, like a loop road
+        ways[14]: [40, 50, 51, 43],
+    }
+    successors = match_successors(deleted_members, way_nodes)
+    assert successors.to_dict("index") == {
+        ways[1]: {"successors": "w10,w11", "action": "split"},
+        ways[2]: {"successors": "w13", "action": "merged"},
+    }
+
+
+def test_detect_splits_and_merges(cdf_set):
+    class Overpass:
+        def get(self, query, verbosity, responseformat):
+            assert query.endswith("way(bn);")
+            return {
+                "elements": [
+                    {"type": "way", "id": 5, "nodes": [1, 2]},
+                    {"type": "way", "id": 6, "nodes": [2, 3, 4]},
+                ]
+            }
+
+    df = cdf_set.source_data
+    split, unmatched = df.index[df["action"] == "deleted"][:2]
+    cdf_set.deleted_way_members = {split: [1, 2, 3, 4], unmatched: [7, 8]}
+    cdf_set.detect_splits_and_merges(Overpass())
+    df = cdf_set.source_data
+    assert df.loc[split, "action"] == "split"
+    assert df.loc[split, "successors"] == "w5,w6"
+    assert df.loc[unmatched, "action"] == "deleted"
+    list(cdf_set.query_modes(["highway", "name"]))
+    # Only the deleted sheet has the split way, with its successors
+    deleted = cdf_set["deleted"]
+    split_id = render_ids([split])[0]
+    assert deleted.loc[split_id, "action"] == "split"
+    assert deleted.loc[split_id, "successors"] == "w5,w6"
+    for mode in ("highway", "name"):
+        assert split_id not in cdf_set[mode].index
+
+
+@pytest.mark.parametrize(
+    "status_file,free,wait",
+    [
+        ("no_slots_waiting", 2, None),
+        ("one_slot_running", 1, None),
+        ("one_slot_waiting", 1, 3),
+        ("two_slots_waiting", 0, 11),
+    ],
+)
+def test_parse_slot_status(status_file, free, wait):
+    text = Path(f"test/overpass_status/{status_file}.txt").read_text()
+    status = parse_slot_status(text)
+    assert free_slots(status, 0) == free
+    if wait:
+        assert min(status.waiting) - status.current_time == timedelta(
+            seconds=wait
+        )
+
+
+@pytest.fixture
+def overpass_server():
+    """
+    Stands in for the Overpass status and interpreter endpoints. The status
+    endpoint replays the given status fixtures in order, repeating the last,
+    and the interpreter answers with an element for each id queried, or times
+    out if more than max_page ids were
+    """
+    server_state = {
+        "statuses": [],
+        "status_requests": 0,
+        "max_page": None,
+        "queries": [],
+        "served": [],
+        "active": 0,
+        "most_active": 0,
+    }
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                statuses = server_state["statuses"]
+                status_file = statuses[
+                    min(server_state["status_requests"], len(statuses) - 1)
+                ]
+                server_state["status_requests"] += 1
+            self.reply(
+                Path(f"test/overpass_status/{status_file}.txt").read_bytes(),
+                "text/plain",
+            )
+
+        def do_POST(self):
+            query = unquote_plus(
+                self.rfile.read(int(self.headers["Content-Length"])).decode()
+            )
+            feature_type, ids = re.search(
+                r"(\w+)\(id:([\d,]+)", query
+            ).groups()
+            ids = ids.split(",")
+            with lock:
+                server_state["queries"].append(ids)
+                server_state["active"] += 1
+                server_state["most_active"] = max(
+                    server_state["most_active"], server_state["active"]
+                )
+            threading.Event().wait(0.05)
+            with lock:
+                server_state["active"] -= 1
+            max_page = server_state["max_page"]
+            if max_page is not None and len(ids) > max_page:
+                self.send_response(504)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            with lock:
+                server_state["served"] += ids
+            if feature_type == "node":
+                geometry = {"lat": 1, "lon": 2}
+            else:
+                geometry = {
+                    "nodes": [1, 2],
+                    "geometry": [
+                        {"lat": 1, "lon": 2},
+                        {"lat": 1.5, "lon": 2.5},
+                    ],
+                }
+            elements = [
+                {
+                    "type": feature_type,
+                    "id": int(fid),
+                    "version": 1,
+                    **geometry,
+                }
+                for fid in ids
+            ]
+            self.reply(
+                json.dumps({"elements": elements}).encode(),
+                "application/json",
+            )
+
+        def reply(self, body: bytes, content_type: str):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    port = server.server_port
+    server_state["endpoint"] = f"http://127.0.0.1:{port}/api/interpreter"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server_state
+    server.shutdown()
+
+
+def test_overpass_query(cdf_set, overpass_server, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(chameleon.core.time, "sleep", sleeps.append)
+    overpass_server["statuses"] = [
+        "two_slots_waiting",
+        "one_slot_waiting",
+        "no_slots_waiting",
+    ]
+    keys = pack_ids(["way"] * 5, range(5))
+    monkeypatch.setattr(ChameleonDataFrameSet, "overpass_keys", keys)
+    cdf_set.page_length = 1
+    query = cdf_set.OverpassQuery(
+        cdf_set, endpoint=overpass_server["endpoint"]
+    )
+    assert query.number_of_queries == 5
+    progress = [query.queries_completed for _ in query.get()]
+    assert query.complete
+    assert len(query._response_features) == 5
+    assert progress == sorted(progress)
+    # Pages grew as they came back quickly
+    assert progress[-1] == query.number_of_queries == 3
+    assert sorted(overpass_server["served"]) == [str(i) for i in range(5)]
+    # Waited for the first slot by the server's clock, then kept both busy
+    assert sleeps == [11]
+    assert overpass_server["most_active"] == 2
+    # Read up front, after the wait, and at most once per finished page
+    # while pages were left
+    assert overpass_server["status_requests"] <= 2 + 3 - 1
+    assert (
+        query.overpass_timeout_time - query.overpass_start_time
+    ).total_seconds() == query.timeout
+
+
+def test_overpass_query_split_pages(cdf_set, overpass_server, monkeypatch):
+    overpass_server["statuses"] = ["no_slots_waiting"]
+    overpass_server["max_page"] = 3
+    keys = pack_ids(["way"] * 20, range(20))
+    monkeypatch.setattr(ChameleonDataFrameSet, "overpass_keys", keys)
+    cdf_set.page_length = 8
+    query = cdf_set.OverpassQuery(
+        cdf_set, endpoint=overpass_server["endpoint"]
+    )
+    for _ in query.get():
+        pass
+    assert query.complete
+    assert sorted(overpass_server["served"], key=int) == [
+        str(i) for i in range(20)
+    ]
+    assert len(query._response_features) == 20
+    assert query.queries_completed == sum(
+        len(ids) <= 3 for ids in overpass_server["queries"]
+    )
+
+    # Pages of a single feature that time out can't be split any further
+    overpass_server["max_page"] = 0
+    query = cdf_set.OverpassQuery(
+        cdf_set, endpoint=overpass_server["endpoint"]
+    )
+    with pytest.raises(overpass.ServerLoadError):
+        for _ in query.get():
+            pass
+
+
+def test_overpass_query_stored_geometries(
+    cdf_set, overpass_server, monkeypatch
+):
+    overpass_server["statuses"] = ["no_slots_waiting"]
+    keys = pack_ids(["way"] * 5, range(5))
+    monkeypatch.setattr(ChameleonDataFrameSet, "overpass_keys", keys)
+    versions = pd.Series(1, index=keys)
+    monkeypatch.setattr(ChameleonDataFrameSet, "overpass_versions", versions)
+
+    def export() -> list[dict]:
+        query = cdf_set.OverpassQuery(
+            cdf_set, endpoint=overpass_server["endpoint"]
+        )
+        for _ in query.get():
+            pass
+        assert query.complete
+        return query._response_features
+
+    first = export()
+    assert len(overpass_server["served"]) == 5
+    assert sorted(export(), key=str) == sorted(first, key=str)
+    assert len(overpass_server["served"]) == 5
+
+    # Only the edited feature is fetched again
+    versions[keys[3]] = 2
+    assert len(export()) == 5
+    assert overpass_server["served"][5:] == ["3"]
+
+
+def test_write_geojson(cdf_set, overpass_server, tmp_path):
+    overpass_server["statuses"] = ["no_slots_waiting"]
+    list(cdf_set.query_modes(["highway", "name"]))
+    out = tmp_path / "out"
+    out.mkdir()
+    path = out / "output.geojson"
+    query = cdf_set.OverpassQuery(
+        cdf_set, endpoint=overpass_server["endpoint"]
+    )
+    for _ in query.write_geojson(path):
+        pass
+    written = json.loads(path.read_text())["features"]
+    attributes = query.attributes
+    # Relations have no geometry of their own
+    assert sorted(feature["id"] for feature in written) == sorted(
+        fid for fid in attributes.index if not fid.startswith("r")
+    )
+    for feature in written[:10]:
+        assert feature["properties"] == attributes.loc[feature["id"]].to_dict()
+
+    # A failed export leaves nothing behind
+    overpass_server["max_page"] = 0
+    cdf_set.geometry_store = None
+    query = cdf_set.OverpassQuery(
+        cdf_set, endpoint=overpass_server["endpoint"]
+    )
+    with pytest.raises(overpass.ServerLoadError):
+        for _ in query.write_geojson(out / "failed.geojson"):
+            pass
+    assert list(out.iterdir()) == [path]
+
+
+def test_geometry_store(tmp_path):
+    def feature(fid: int, version: int) -> dict:
+        return {
+            "type": "Feature",
+            "geometry": {
+                "type": "LineString",
+                "coordinates": [[0, 0], [1, 1]],
+            },
+            "properties": {"type": "way", "id": fid, "version": version},
+        }
+
+    store = GeometryStore(tmp_path / "geometries.sqlite")
+    store.put_many([feature(1, 3), feature(2, 1)])
+    keys = pack_ids(["way"] * 3, [1, 2, 3])
+    found = store.get_many(pd.Series([3, 2, 1], index=keys))
+    # Way 2 is stored at another version and way 3 not at all
+    assert found == {keys[0]: feature(1, 3)}
+
+    # Past its size, the least recently used feature is evicted
+    size = len(json.dumps(feature(1, 3)))
+    store.max_size = 5 * size // 2
+    store.get_many(pd.Series([1], index=keys[1:2]))
+    store.put_many([feature(3, 1)])
+    assert list(store.get_many(pd.Series([3, 1, 1], index=keys))) == list(
+        keys[1:]
+    )
+    # Features written together are evicted one by one
+    store.put_many([feature(fid, 1) for fid in range(4, 7)])
+    stored = store.find(pd.Series(1, index=pack_ids(["way"] * 7, range(7))))
+    assert len(stored) == 2
+    assert store.connection.execute(
+        "SELECT total FROM geometries_size"
+    ).fetchone() == (2 * size,)
+
+
+def test_store_failures(tmp_path, caplog):
+    element_store = ElementStore(tmp_path / "elements.sqlite")
+    geometry_store = GeometryStore(tmp_path / "geometries.sqlite")
+    for store in (element_store, geometry_store):
+        # Fails like a database another process has locked
+        store.connection.close()
+    keys = pd.Series([1], index=pack_ids(["way"], [1]))
+    element_store.put_many("way", [{"id": 1, "version": 1}])
+    assert element_store.get_many([OsmObj("way", "1")]) == {}
+    geometry_store.put_many([])
+    assert geometry_store.get_many(keys) == {}
+    assert geometry_store.find(keys) == []
+    # Only logged once, then the stores are left alone
+    assert element_store.failed and geometry_store.failed
+    assert len(caplog.records) == 2
+
+
+def test_adapted_page_length():
+    # Slow pages shrink, fast ones grow at most twofold
+    assert adapted_page_length(2000, 2000, 60, 1000) == 1000
+    assert adapted_page_length(2000, 2000, 1, 1000) == 4000
+    # Pages of long ways are held to a number of geometry points
+    assert adapted_page_length(2000, 2000, 1, 4_000_000) == 500
+
+
+def test_max_groups():
+    codes = np.array([0, 1, 0, 2, 1])
+    values = ["2020-01-02", "9", "2021-05-01", "3", "10"]
+    # Strings compare as strings, and groups without values are missing
+    assert max_groups(codes, values, 4).tolist() == [
+        "2021-05-01",
+        "9",
+        "3",
+        None,
+    ]
+
+
+def test_element_store(tmp_path):
+    store = ElementStore(tmp_path / "elements.sqlite")
+    deleted = {"id": 2, "version": 3, "visible": False, "nodes": [1, 2]}
+    visible = {
+        "id": 1,
+        "version": 5,
+        "visible": True,
+        "user": "someone",
+        "changeset": 42,
+        "timestamp": "2020-05-07T15:40:29Z",
+    }
+    store.put_many("way", [visible, deleted])
+    features = [OsmObj("way", "1"), OsmObj("way", "2"), OsmObj("node", "1")]
+    found = store.get_many(features)
+    assert found[OsmObj("way", "1")] == visible
+    assert found[OsmObj("way", "2")]["nodes"] == [1, 2]
+    assert OsmObj("node", "1") not in found
+
+    # Visible elements can still change, deleted ones can't
+    store.max_age = timedelta(0)
+    time.sleep(0.01)
+    assert list(store.get_many(features)) == [OsmObj("way", "2")]